@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 
+import os
 try:
     import argparse
 except ImportError:
     from local_libs import argparse_local as argparse
 import ConfigParser
 
-from dlib.ansible_helpers import flatten_ansible_struct, fetch_struct, run_custom_command, gut_struct, save_struct
+from dlib.ansible_helpers import run_concurrently, gut_struct, load_struct, stale_hosts, list_hosts, \
+    in_shard
+from dlib.compression import COMPRESSIONS
+from dlib.journal import Journal
+from dlib.json_stream import JsonObjectWriter
+from dlib.projection import Projection
+from dlib.snapshot import Snapshot, is_snapshot, save_snapshot
 
 
 def load_ini(path):
@@ -29,6 +36,35 @@ def load_ini(path):
     return result
 
 
+def parse_shard(value):
+    """
+    Parse a shard given as k/n on the command line
+
+    :param value: The shard as passed
+    :type value: str
+    :return: Tuple of the number of the shard and the total number of shards
+    :rtype: tuple
+    """
+    try:
+        shard, shards = [int(i) for i in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is not of the form k/n" % value)
+    if not 1 <= shard <= shards:
+        raise argparse.ArgumentTypeError("Shard %s is not between 1 and %s" % (shard, shards))
+    return shard, shards
+
+
+def load_cache(path):
+    """
+    :param path: Path of a json or snapshot cache file
+    :type path: str
+    :rtype: dict
+    """
+    if is_snapshot(path):
+        return Snapshot(path).materialize(0)
+    return load_struct(path)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Fetch information from remote systems using Ansible")
     required = parser.add_argument_group('required arguments')
@@ -46,21 +82,102 @@ if __name__ == '__main__':
     parser.add_argument("--skeleton", "-s", action="store_true", required=False, default=False,
                         help="Remove all values from the datastructure, essentially leaving only the structure "
                              "itself. Useful in combination with --realtime")
+    parser.add_argument("--snapshot", action="store_true", required=False, default=False,
+                        help="Write a binary snapshot, which datamounter.py can memory map, instead of json.")
+    parser.add_argument("--max-age", dest="max_age", type=int, required=False, default=None,
+                        help="Only gather the hosts which are missing from the existing destination file or were "
+                             "gathered more than this many seconds ago, and merge them into it.")
+    parser.add_argument("--workers", "-w", dest="workers", type=int, required=False, default=4,
+                        help="Number of Ansible runs (the setup module and custom commands) to do at the same time. "
+                             "Defaults to 4")
+    parser.add_argument("--max-forks", dest="max_forks", type=int, required=False, default=50,
+                        help="Total number of concurrent connections. Every running custom command gets this "
+                             "divided by --workers and the setup module gets the rest. Defaults to 50")
+    parser.add_argument("--forks", dest="forks", type=int, required=False, default=None,
+                        help="Number of connections the setup module starts with. It is tuned while gathering, "
+                             "up to what the custom commands leave of --max-forks. Defaults to all of that")
+    parser.add_argument("--timeout", "-t", dest="timeout", type=int, required=False, default=5,
+                        help="Seconds after which a connection times out. Defaults to 5")
+    parser.add_argument("--deadline", dest="deadline", type=float, required=False, default=None,
+                        help="Seconds after which no new batches or retries of the setup module are started. "
+                             "Hosts not gathered by then are skipped")
+    parser.add_argument("--shard", dest="shard", type=parse_shard, required=False, default=None,
+                        help="Only gather shard k of n of the hosts, given as k/n. Hosts are assigned to a shard by "
+                             "a hash of their name. Combine the shards with cache_tool.py merge")
+    parser.add_argument("--include", dest="include", action="append", required=False, default=None,
+                        help="Only store the facts matching this path pattern relative to the host, e.g. "
+                             "ansible_eth* or mounts/*/device. Can be given multiple times. A single include "
+                             "pattern is passed to the setup module as a filter when possible")
+    parser.add_argument("--exclude", dest="exclude", action="append", required=False, default=None,
+                        help="Don't store the facts matching this path pattern relative to the host, e.g. "
+                             "ansible_env or */options. Can be given multiple times")
+    parser.add_argument("--compress", dest="compress", choices=COMPRESSIONS, required=False, default=None,
+                        help="Compress the json file while it is written. Compressed files are detected when they "
+                             "are loaded")
     args = parser.parse_args()
 
+    pattern = args.pattern
+    old_struct = None
+    hosts = None
+    if args.max_age is not None and os.path.exists(args.filename):
+        old_struct = load_cache(args.filename)
+        hosts = stale_hosts(args.pattern, old_struct, args.max_age)
+        if not hosts:
+            print "All hosts were gathered less than %s seconds ago" % args.max_age
+            raise SystemExit
+        print "Gathering %s stale or missing hosts" % len(hosts)
+        pattern = ':'.join(hosts)
+
+    if args.shard:
+        if hosts is None:
+            hosts = list_hosts(pattern)
+        hosts = [host for host in hosts if in_shard(host, *args.shard)]
+        print "Gathering %s hosts in shard %s/%s" % ((len(hosts),) + args.shard)
+        pattern = ':'.join(hosts)
+
     if args.custom:
         cust_input = load_ini(args.custom)
-        custom_commands = {}
-        for host in cust_input.keys():
-            for filename in cust_input[host].keys():
-                custom_commands[filename] = run_custom_command(host, cust_input[host][filename], args.pattern,
-                                                               args.skeleton)
-
     else:
-        custom_commands = None
+        cust_input = None
 
-    tempstruct = fetch_struct(args.pattern, args.retries)
-    struct = flatten_ansible_struct(tempstruct, custom_commands)
-    if args.skeleton:
-        gut_struct(struct)
-    save_struct(args.filename, struct)
+    # Every gathered host is recorded in the journal, so an interrupted run with the same arguments can
+    # resume with only the hosts that remain
+    header = {'pattern': args.pattern, 'custom': args.custom, 'skeleton': args.skeleton, 'max_age': args.max_age,
+              'shard': args.shard and list(args.shard), 'include': args.include, 'exclude': args.exclude}
+    journal = Journal(args.filename + '.journal', header)
+    if journal.done:
+        if hosts is None:
+            hosts = list_hosts(pattern)
+        hosts = [host for host in hosts if host not in journal.done]
+        print "Resuming, %s hosts were gathered already and %s remain" % (len(journal.done), len(hosts))
+        pattern = ':'.join(hosts)
+
+    def write_host(host, host_struct):
+        if args.skeleton:
+            gut_struct(host_struct)
+        journal.write(host, host_struct)
+
+    if pattern:
+        run_concurrently(pattern, args.retries, cust_input, args.skeleton, args.workers, args.max_forks,
+                         args.forks, args.timeout, args.deadline, write_host, Projection(args.include, args.exclude))
+    journal.close()
+
+    # Json caches are written host by host from the journal, snapshots need every host up front
+    if args.snapshot:
+        if args.compress:
+            print "Ignoring --compress for a snapshot, which needs to be memory mapped"
+        struct = dict(journal.entries())
+        if old_struct is not None:
+            old_struct.update(struct)
+            struct = old_struct
+        save_snapshot(args.filename, struct)
+    else:
+        writer = JsonObjectWriter(args.filename, args.compress)
+        for host, host_struct in journal.entries():
+            writer.write(host, host_struct)
+        if old_struct is not None:
+            for host in old_struct.keys():
+                if host not in writer.keys:
+                    writer.write(host, old_struct.pop(host))
+        writer.close()
+    journal.remove()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import json
+import mmap
+try:
+    import argparse
+except ImportError:
+    from local_libs import argparse_local as argparse
+
+from dlib.ansible_helpers import load_struct
+from dlib.compression import COMPRESSIONS, detect_compression, open_cache
+from dlib.json_stream import JsonObjectWriter
+from dlib.lazy_json import iter_members, scan_object
+from dlib.snapshot import Snapshot, is_snapshot, save_snapshot
+
+
+def snapshot(args):
+    save_snapshot(args.destination, load_struct(args.source))
+
+
+def iter_hosts(source):
+    """
+    :param source: Path of a json cache, compressed json cache or snapshot
+    :type source: str
+    :return: Generator of (host, json encoded host) tuples, reading one host at a time
+    :rtype: generator
+    """
+    if is_snapshot(source):
+        snap = Snapshot(source)
+        for host, number in snap.child_numbers(0).iteritems():
+            yield host, json.dumps(snap.materialize(number))
+    elif detect_compression(source):
+        f = open_cache(source)
+        for host, data in iter_members(f):
+            yield host, data
+        f.close()
+    else:
+        f = open(source, 'rb')
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        for host, start, end in scan_object(mm):
+            yield host, mm[start:end]
+        mm.close()
+
+
+def host_names(source):
+    """
+    :param source: Path of a json cache, compressed json cache or snapshot
+    :type source: str
+    :return: The name of every host in the cache. The hosts of a snapshot are not materialized for this.
+    :rtype: list
+    """
+    if is_snapshot(source):
+        return Snapshot(source).child_numbers(0).keys()
+    return [host for host, _ in iter_hosts(source)]
+
+
+def merge(args):
+    """
+    Merge caches host by host into a json cache. The first pass only collects which source every host is
+    taken from, the second pass copies the hosts over one at a time, json hosts without decoding them.
+    When a host is in multiple sources, the last source wins.
+    """
+    sources = {}
+    for number, source in enumerate(args.sources):
+        for host in host_names(source):
+            sources[host] = number
+
+    writer = JsonObjectWriter(args.destination, args.compress)
+    for number, source in enumerate(args.sources):
+        for host, data in iter_hosts(source):
+            if sources[host] == number:
+                writer.write_raw(host, data)
+    writer.close()
+    print "Merged %s hosts from %s caches" % (len(sources), len(args.sources))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert and combine datamounter cache files")
+    subparsers = parser.add_subparsers()
+
+    snapshot_parser = subparsers.add_parser("snapshot", help="Convert a json cache, compressed or not, into a "
+                                                             "snapshot")
+    snapshot_parser.add_argument("source", help="The json cache to convert")
+    snapshot_parser.add_argument("destination", help="Destination filename for the snapshot")
+    snapshot_parser.set_defaults(func=snapshot)
+
+    merge_parser = subparsers.add_parser("merge", help="Merge caches, such as shards, into a json cache")
+    merge_parser.add_argument("destination", help="Destination filename for the json cache")
+    merge_parser.add_argument("sources", nargs="+", help="The json caches or snapshots to merge. When a host is "
+                                                          "in multiple caches, the last one wins")
+    merge_parser.add_argument("--compress", dest="compress", choices=COMPRESSIONS, default=None,
+                              help="Compress the json cache while it is written")
+    merge_parser.set_defaults(func=merge)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -4,6 +4,12 @@ import sys
 
 from dlib.datamounter_helpers import DataFS, load_struct
 from dlib.ansible_helpers import gut_struct
+from dlib.snapshot import Snapshot, SnapshotIndex, is_snapshot
+from dlib.compression import detect_compression
+from dlib.lazy_json import LazyIndex, load_projected
+from dlib.path_index import PathIndex
+from dlib.projection import Projection
+from dlib.reloader import file_version
 
 try:
     import argparse
@@ -15,8 +21,45 @@ except ImportError:
     from local_libs.fuse_local import FUSE
 
 
-def main(datastruct, mountpoint, f, realtime, allow_other, utime, clean):
-    FUSE(DataFS(datastruct, realtime, utime, clean), mountpoint, allow_other=allow_other, foreground=f, ro=True)
+def load_index(cache, projection, skeleton=False, lazy=False, lazy_hosts=256, save_offsets=False):
+    """
+    Load a cache file into the index to mount
+
+    :param cache: Path of the json cache, compressed json cache or snapshot
+    :type cache: str
+    :param projection: Only load what this projection selects of every host
+    :type projection: dlib.projection.Projection
+    :param skeleton: Remove all values, leaving only the structure
+    :type skeleton: bool
+    :param lazy: Only decode a host once it is accessed
+    :type lazy: bool
+    :param lazy_hosts: Maximum number of decoded hosts to keep with lazy
+    :type lazy_hosts: int
+    :param save_offsets: Save the location of every host next to the cache with lazy
+    :type save_offsets: bool
+    :rtype: dlib.path_index.PathIndex
+    """
+    if is_snapshot(cache):
+        return SnapshotIndex(Snapshot(cache))
+
+    if lazy and not detect_compression(cache):
+        if skeleton:
+            transform = gut_struct
+        else:
+            transform = None
+        return LazyIndex(cache, lazy_hosts, save_offsets, transform, projection=projection)
+
+    if projection:
+        struct = load_projected(cache, projection)
+    else:
+        struct = load_struct(cache)
+    if skeleton:
+        gut_struct(struct)
+    return PathIndex(struct)
+
+
+def main(datastruct, mountpoint, f, allow_other, **options):
+    FUSE(DataFS(datastruct, **options), mountpoint, allow_other=allow_other, foreground=f, ro=True)
 
 
 if __name__ == "__main__":
@@ -28,10 +71,23 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Mount virtual filesystem using json/ansible as input")
     parser.add_argument("mountpoint", help="Where to mount the filesystem", nargs="+")
     required = parser.add_argument_group('required arguments')
-    required.add_argument("--cache", "-c", dest="cache", required=True, help="Location of the cache-file.")
+    required.add_argument("--cache", "-c", dest="cache", required=True,
+                          help="Location of the cache-file. Either json or a snapshot created with --snapshot.")
     parser.add_argument("--updatetime", dest="utime", required=False, type=int, default=10,
                         help="""Optionally tell the mounter how long the contents of files will be cached after which
                         the fact is retrieved again. To be used with --realtime. Defaults to 10 seconds""")
+    parser.add_argument("--max-stale", dest="max_stale", required=False, type=int, default=None,
+                        help="""Reads return the last known contents and refresh them in the background. When the
+                        contents are older than this many seconds, the read waits for the refresh instead. Contents
+                        from the cache count as fetched when the host was gathered. To be used with --realtime.
+                        Defaults to only waiting when there are no contents, as with --skeleton or once they were
+                        emptied""")
+    parser.add_argument("--forks", dest="forks", required=False, type=int, default=10,
+                        help="""Number of concurrent connections used when refreshing hosts. To be used with
+                        --realtime. Defaults to 10""")
+    parser.add_argument("--batch-window", dest="batch_window", required=False, type=float, default=0.2,
+                        help="""Hosts needing a refresh within this many seconds of each other are refreshed in a
+                        single Ansible run. To be used with --realtime. Defaults to 0.2 seconds""")
     parser.add_argument("--foreground", "-f", action="store_true", default=False, dest="foreground",
                         help="Run in foreground", required=False)
     parser.add_argument("--allow_other", "-a", action="store_true", required=False,
@@ -41,24 +97,71 @@ if __name__ == "__main__":
                         Useful in combination with --realtime""")
     parser.add_argument("--realtime", action="store_true", required=False, help="Fetch data realtime.",
                         dest="realtime", default=False)
+    parser.add_argument("--lazy", "-l", action="store_true", default=False, dest="lazy",
+                        help="Only decode the data of a host once it is accessed instead of loading the whole cache.")
+    parser.add_argument("--lazy-hosts", dest="lazy_hosts", type=int, default=256,
+                        help="""Maximum number of decoded hosts to keep in memory with --lazy. Hosts refreshed with
+                        --realtime don't count, --max-resident limits those. Defaults to 256""")
+    parser.add_argument("--save-offsets", action="store_true", default=False, dest="save_offsets",
+                        help="""Save the location of every host in the cache next to it and reuse it for later mounts
+                        with --lazy, as long as the cache does not change""")
+    parser.add_argument("--expire", dest="expire", required=False, type=int, default=60,
+                        help="""Number of seconds after which data fetched in realtime is emptied again, unless it
+                        was refreshed in the meantime. To be used with --realtime. Defaults to 60 seconds""")
+    parser.add_argument("--max-resident", dest="max_resident", required=False, type=int, default=None,
+                        help="""Maximum number of megabytes of data fetched in realtime to keep. When exceeded, the
+                        data of the least recently read hosts is emptied again. The current number of bytes can be
+                        read from .datamounter/resident_bytes. To be used with --realtime. Defaults to no limit""")
+    parser.add_argument("--include", dest="include", action="append", required=False, default=None,
+                        help="""Only expose the facts matching this path pattern relative to the host, e.g. ansible_eth*
+                        or mounts/*/device. Can be given multiple times. Everything else is skipped while decoding the
+                        cache""")
+    parser.add_argument("--exclude", dest="exclude", action="append", required=False, default=None,
+                        help="""Don't expose the facts matching this path pattern relative to the host, e.g.
+                        ansible_env or */options. Can be given multiple times""")
+    parser.add_argument("--reload", dest="reload", required=False, type=int, default=None,
+                        help="""Check every this many seconds whether the cache file was replaced, and if so load the
+                        new version in the background and swap it in without remounting. Defaults to never""")
     parser.add_argument("--disable-cleanup", "-d", action="store_true", default=False, dest="disable_cleanup",
-                        help="Disable the cleanup thread. Use only when you have trouble with threading.")
+                        help="""Disable the cleanup thread, which empties data fetched in realtime once it expires.
+                        Use only when you have trouble with threading.""")
 
     args = parser.parse_args()
     print "Loading data"
 
-    struct = load_struct(args.cache)
-
-    if args.skeleton:
-        gut_struct(struct)
-
+    projection = Projection(args.include, args.exclude)
+    if is_snapshot(args.cache):
+        if args.skeleton:
+            print "Ignoring --skeleton for a snapshot, create the snapshot with --skeleton instead"
+        if projection:
+            print "Ignoring --include and --exclude for a snapshot, pass them to ansible_fetcher.py instead"
+            projection = None
+    elif args.lazy and detect_compression(args.cache):
+        print "Ignoring --lazy for a compressed cache, which can't be memory mapped"
+    # Taken before loading, so a cache replaced while it loads is picked up by --reload
+    version = file_version(args.cache)
+    index = load_index(args.cache, projection, args.skeleton, args.lazy, args.lazy_hosts, args.save_offsets)
     print "done"
+    if args.max_resident is not None:
+        max_resident = args.max_resident * 1024 * 1024
+    else:
+        max_resident = None
     if args.realtime and not args.disable_cleanup:
         cleanup = True
     else:
         cleanup = False
 
+    if args.reload:
+        options = dict(reload_file=args.cache, reload_interval=args.reload, reload_version=version,
+                       load=lambda: load_index(args.cache, projection, args.skeleton, args.lazy, args.lazy_hosts,
+                                               args.save_offsets))
+    else:
+        options = {}
+
     try:
-        main(struct, args.mountpoint[0], args.foreground, args.realtime, args.allow_other, args.utime, cleanup)
+        main(struct, args.mountpoint[0], args.foreground, args.allow_other, realtime=args.realtime, utime=args.utime,
+             cleanup=cleanup, index=index, max_stale=args.max_stale, forks=args.forks,
+             batch_window=args.batch_window, expire=args.expire, max_resident=max_resident, projection=projection,
+             **options)
     except KeyboardInterrupt:
         sys.exit()
@@ -1,110 +1,211 @@
+import hashlib
 import json
-import ansible.inventory
+import multiprocessing
+import Queue
+import threading
+import time
 import ansible.runner
 
+from compression import detect_compression, open_cache
+from fetch_scheduler import ForkTuner, backoff_delay
+from inventory_cache import inventory_cache
+from json_stream import JsonObjectWriter
+from lazy_json import iter_members
 
-def flatten_ansible_struct(struct, custom_output=None):
+# Top level directories of a host which flatten_host renamed from the fact gathered
+FACT_NAMES = {
+    'mounts': 'ansible_mounts',
+    'local_facts': 'ansible_local',
+}
+
+
+def run_in_process(func, *args):
     """
-    Make an ansible dictionary usable for mounting by moving the everything under the
-    "contacted" key one level higher and inserting things like local facts.
+    Call func with args in a forked process of its own and return its result. ansible.runner.Runner.run()
+    keeps the runner in a module global, which the workers it forks read their module and arguments from,
+    so runners started from threads of the same process can end up executing each other's module. Every
+    run of a runner which may happen next to another one has to go through this.
+
+    :param func: The function to call, e.g. the run method of an ansible.runner.Runner
+    :type func: function
+    :return: What func returned
+    :raises RuntimeError: When func raised an exception or the process died
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_call_and_send, args=(sender, func, args))
+    process.start()
+    sender.close()
+    try:
+        succeeded, result = receiver.recv()
+    except EOFError:
+        succeeded, result = False, 'exited without a result'
+    finally:
+        receiver.close()
+        process.join()
+    if not succeeded:
+        raise RuntimeError('Running %s failed: %s' % (getattr(func, '__name__', func), result))
+    return result
+
+
+def _call_and_send(connection, func, args):
+    try:
+        outcome = (True, func(*args))
+    except Exception, e:
+        outcome = (False, '%s: %s' % (type(e).__name__, e))
+    connection.send(outcome)
+    connection.close()
 
-    :param struct: A dictionary created with ansible.runner
-    :type struct: dict
-    :param custom_output: Dictionary containing the output of custom commands.
-    :return: A modified (flattened and enriched) structure
+
+def flatten_host(facts, custom_output=None, projection=None):
+    """
+    Make the facts gathered for a single host usable for mounting by inserting things like local facts and
+    the output of custom commands.
+
+    :param facts: The ansible_facts returned by the setup module for the host
+    :type facts: dict
+    :param custom_output: Dictionary of filename to the output of that custom command on the host
+    :type custom_output: dict
+    :param projection: Only keep the parts of the host selected by this projection
+    :type projection: dlib.projection.Projection
+    :return: The flattened and enriched structure of the host
     :rtype: dict
     """
-    newstruct = {}
-    tempstruct = {}
+    host_struct = dict(facts)
+
+    # Rename ansible_local to local_facts if any
     try:
-        for host in struct['contacted']:
-            tempstruct[host] = struct['contacted'][host]['ansible_facts']
+        host_struct['local_facts'] = host_struct.pop('ansible_local')
     except KeyError:
         pass
 
-    # Remove ipv4 and put contents one "dir" higher
-    for host in tempstruct.keys():
-        for item in tempstruct[host].keys():
-            try:
-                newstruct[host][item] = tempstruct[host][item]
-            except KeyError:
-                newstruct[host] = {item: tempstruct[host][item]}
+    # Walk through "ansible_mounts" (list) and create direntries
+    for mount in host_struct.pop('ansible_mounts', []):
+        diskname = mount['device'].split('/')[-1]
+        host_struct.setdefault('mounts', {})[diskname] = mount
 
-    # Rename ansible_local to local_facts if any
-    for host in newstruct.keys():
-        try:
-            newstruct[host]['local_facts'] = newstruct[host].pop('ansible_local')
-        except KeyError:
-            pass
+    if custom_output:
+        host_struct['custom_commands'] = custom_output
 
-    # Walk through "ansible_mounts" (list) and create direntries
-    for host in newstruct.keys():
-        for mount in newstruct[host]['ansible_mounts']:
-            diskname = mount['device'].split('/')[-1]
-            try:
-                newstruct[host]['mounts'][diskname] = mount
-            except KeyError:
-                newstruct[host]['mounts'] = {diskname: mount}
+    # Remove SSH_AUTH_SOCK from ansible_env
+    try:
+        host_struct['ansible_env'].pop('SSH_AUTH_SOCK')
+    except KeyError:
+        pass
 
-        newstruct[host].pop('ansible_mounts')
+    if projection:
+        host_struct = projection.apply(host_struct)
+    return host_struct
 
+
+def pushdown_filter(include):
+    """
+    Find a filter for the setup module which gathers no less than the include patterns of a Projection
+    select, so facts which are dropped anyway don't have to be transferred. The setup module only takes a
+    single pattern for the names of top level facts, so this is only possible for a single include pattern
+    starting with a literal fact name, or consisting of a literal prefix followed by *.
+
+    :param include: The include patterns
+    :type include: list
+    :return: The filter or None when everything needs to be gathered
+    :rtype: str
+    """
+    if not len(include) == 1:
+        return None
+
+    pattern = include[0]
+    top = pattern.split('/')[0]
+    if not any(char in top for char in '*?['):
+        return FACT_NAMES.get(top, top)
+
+    prefix = pattern[:-1]
+    if pattern.endswith('*') and '/' not in prefix and not any(char in prefix for char in '*?['):
+        renamed = FACT_NAMES.keys() + ['custom_commands']
+        if not any(name.startswith(prefix) for name in renamed):
+            return pattern
+    return None
+
+
+def host_custom_output(custom_output, host):
+    """
+    :param custom_output: Dictionary of filename to the output of that custom command, as generated by
+                          ansible.runner.Runner
+    :type custom_output: dict
+    :param host: The host to get the output of
+    :type host: str
+    :return: Dictionary of filename to the output of that custom command on the host
+    :rtype: dict
+    """
+    output = {}
     if custom_output:
-        # Remove empty dicts
-        [custom_output.pop(i) for i in custom_output.keys() if custom_output[i] == {}]
-        for filename in custom_output.keys():
-            if not custom_output[filename]:
-                continue
+        for filename, result in custom_output.items():
+            if result and host in result.get('contacted', {}):
+                output[filename] = result['contacted'][host]
+    return output
 
-            for host in custom_output[filename]['contacted'].keys():
-                if host not in newstruct.keys():
-                    continue
 
-                output = custom_output[filename]['contacted'][host]
-                try:
-                    newstruct[host]['custom_commands'][filename] = output
-                except KeyError:
-                    newstruct[host]['custom_commands'] = {filename: output}
+def flatten_ansible_struct(struct, custom_output=None):
+    """
+    Make an ansible dictionary usable for mounting by moving the everything under the
+    "contacted" key one level higher and flattening every host with flatten_host.
 
-    # Remove SSH_AUTH_SOCK from ansible_env
-    for host in newstruct.keys():
+    :param struct: A dictionary created with ansible.runner
+    :type struct: dict
+    :param custom_output: Dictionary containing the output of custom commands.
+    :return: A modified (flattened and enriched) structure
+    :rtype: dict
+    """
+    newstruct = {}
+    for host, result in struct.get('contacted', {}).items():
         try:
-            newstruct[host]['ansible_env'].pop('SSH_AUTH_SOCK')
+            facts = result['ansible_facts']
         except KeyError:
-            pass
+            continue
+        newstruct[host] = flatten_host(facts, host_custom_output(custom_output, host))
 
     return newstruct
 
 
-def get_real_data(host, custom_commands=None):
+def get_real_data(hosts, custom_commands=None, forks=1, fact_filter=None):
     """
-    Runs the setup module on a host. When passed a custom command, it is appended to the returned struct
-
-    :param host: The host to run on
-    :type host: str
-    :param custom_commands: The custom command that needs to be included
-    :type custom_commands: list
-    :return: A dictionary containing the output of the setup module as generated by ansible.runner.Runner
+    Runs the setup module on one or more hosts in a single run, in a process of its own so runs for other
+    facts can happen at the same time. When passed custom commands for a host, they are appended to the
+    returned struct of that host
+
+    :param hosts: The hosts to run on
+    :type hosts: list
+    :param custom_commands: Dictionary of host to the custom commands that need to be included
+    :type custom_commands: dict
+    :param forks: Number of concurrent connections to use
+    :type forks: int
+    :param fact_filter: Only return the facts matching this pattern, as supported by the setup module
+    :type fact_filter: str
+    :return: A dictionary containing the flattened output of the setup module per contacted host
     :rtype: dict
 
     """
+    if fact_filter:
+        module_args = "filter=%s" % fact_filter
+    else:
+        module_args = ""
+
     runner = ansible.runner.Runner(
         module_name="setup",
-        module_args="",
-        forks=1,
-        pattern=host,
+        module_args=module_args,
+        forks=forks,
+        pattern=':'.join(hosts),
+        inventory=inventory_cache.inventory(),
     )
-    data = runner.run()
+    data = run_in_process(runner.run)
 
-    try:
-        struct = flatten_ansible_struct(data)
-        if custom_commands:
-            struct[host]['custom_commands'] = custom_commands
-        return struct
-    except KeyError:
-        pass
+    struct = flatten_ansible_struct(data)
+    if custom_commands:
+        for host in struct.keys():
+            if custom_commands.get(host):
+                struct[host]['custom_commands'] = custom_commands[host]
+    return struct
 
 
-def run_custom_command(host, command, run_pattern=None, skeleton=False):
+def run_custom_command(host, command, run_pattern=None, skeleton=False, forks=5):
     """
     Runs a custom command on a host and returns the output in a dictionary as generated by ansible.runner.Runner
 
@@ -116,6 +217,8 @@ def run_custom_command(host, command, run_pattern=None, skeleton=False):
     :type run_pattern: list
     :param skeleton: Whether we are generating a skeleton. If True, don't actually run anything.
     :type skeleton: bool
+    :param forks: Number of concurrent connections to use
+    :type forks: int
     :return: Datastructure generated by ansible.runner.Runner
     :rtype: dict
     """
@@ -123,9 +226,8 @@ def run_custom_command(host, command, run_pattern=None, skeleton=False):
     if not run_pattern:
         run_pattern = []
 
-    inventory = ansible.inventory.Inventory()
-    run_host_inventory = [i.name for i in inventory.get_hosts(run_pattern)]
-    custom_inventory = [i.name for i in inventory.get_hosts(host)]
+    run_host_inventory = set(list_hosts(run_pattern))
+    custom_inventory = list_hosts(host)
     new_pattern = []
 
     for run_host in custom_inventory:
@@ -157,12 +259,14 @@ def run_custom_command(host, command, run_pattern=None, skeleton=False):
     runner = ansible.runner.Runner(
         module_name="shell",
         module_args=command,
+        forks=forks,
         pattern=host,
+        inventory=inventory_cache.inventory(),
     )
-    return runner.run()
+    return run_in_process(runner.run)
 
 
-def gen_runner(pattern, forks=50, timeout=5):
+def gen_runner(pattern, forks=50, timeout=5, fact_filter=None):
     import ansible.runner
     """
     Create an ansible runner for the setup module
@@ -173,51 +277,213 @@ def gen_runner(pattern, forks=50, timeout=5):
     :type forks: int
     :param timeout: Seconds after which to timeout
     :type timeout: int
+    :param fact_filter: Only return the facts matching this pattern, as supported by the setup module
+    :type fact_filter: str
     :return: An instance of ansible.runner.Runner
     :rtype: ansible.runner.Runner
     """
+    if fact_filter:
+        module_args = "filter=%s" % fact_filter
+    else:
+        module_args = ""
+
     runner = ansible.runner.Runner(
         module_name="setup",
-        module_args="",
+        module_args=module_args,
         forks=forks,
         pattern=pattern,
         timeout=timeout,
+        inventory=inventory_cache.inventory(),
     )
 
     return runner
 
 
-def fetch_struct(pattern, retries=0):
+def fetch_struct(pattern, retries=0, forks=50, timeout=5, deadline=None, max_forks=None, callback=None,
+                 fact_filter=None):
     """
-    Create a basic structure using ansible's Runner
+    Create a basic structure using ansible's Runner. The hosts are gathered in batches, several of which run
+    at the same time so hosts which take long don't hold up the others. Between batches the number of forks
+    is tuned with a ForkTuner. Hosts which are unreachable or time out are retried up to retries times after
+    an exponential backoff with jitter, stopping as soon as every host answered.
 
     :param pattern: Host pattern to run on
     :type pattern: str
     :param retries: Number of retries to use when host is unreachable or times out
     :type retries: int
+    :param forks: Number of concurrent connections to start with
+    :type forks: int
+    :param timeout: Seconds after which a connection times out
+    :type timeout: int
+    :param deadline: Seconds after which no new batches or retries are started. Hosts not gathered by
+                     then are left in "dark".
+    :type deadline: float
+    :param max_forks: Maximum number of concurrent connections the ForkTuner may go up to, defaults to four
+                      times forks
+    :type max_forks: int
+    :param callback: Called with the "contacted" part of the output of every batch as soon as it completes.
+                     The contacted hosts are then not kept in the returned structure.
+    :type callback: function
+    :param fact_filter: Only return the facts matching this pattern, as supported by the setup module
+    :type fact_filter: str
     :return: A dictionary containting the output of the setup module
     :rtype: dict
     """
-    runner = gen_runner(pattern)
-    struct = runner.run()
+    if deadline is not None:
+        deadline = time.time() + deadline
+
+    pending = list_hosts(pattern)
+    struct = {'contacted': {}, 'dark': {}}
+    tuner = ForkTuner(forks, timeout, max_forks=max_forks)
+    completed = Queue.Queue()
+
+    def run_batch(batch, version):
+        started = time.time()
+        try:
+            newstruct = run_in_process(gen_runner(':'.join(batch), forks=len(batch), timeout=timeout,
+                                                  fact_filter=fact_filter).run)
+        except Exception, e:
+            completed.put((batch, version, started, None, e))
+        else:
+            completed.put((batch, version, started, newstruct, None))
+
+    for attempt in range(int(retries) + 1):
+        if attempt:
+            pending = struct['dark'].keys()
+            if not pending:
+                break
+            delay = backoff_delay(attempt - 1)
+            if deadline is not None and time.time() + delay > deadline:
+                break
+            print "Retrying %s in %.1f seconds" % (':'.join(pending), delay)
+            time.sleep(delay)
+
+        running = 0
+        in_flight = 0
+        while pending or running:
+            if deadline is not None and time.time() > deadline:
+                for host in pending:
+                    struct['dark'].setdefault(host, {'failed': True, 'msg': 'Deadline exceeded'})
+                pending = []
+
+            while pending and in_flight < tuner.forks:
+                size = min(tuner.batch_size(), tuner.forks - in_flight)
+                batch, pending = pending[:size], pending[size:]
+                thread = threading.Thread(target=run_batch, args=(batch, tuner.version))
+                thread.daemon = True
+                thread.start()
+                running += 1
+                in_flight += len(batch)
+
+            if not running:
+                break
+            batch, version, started, newstruct, error = completed.get()
+            running -= 1
+            in_flight -= len(batch)
+            if error is not None:
+                raise error
+            tuner.record(len(batch), len(newstruct['dark']), time.time() - started, version)
 
-    for r in range(int(retries)):
-        if not len(struct['dark']) == 0:
-            newpattern = ':'.join(struct['dark'].keys())
-            print "Retrying %s" % newpattern
-            newrunner = gen_runner(newpattern, forks=10, timeout=2)
-            newstruct = newrunner.run()
-            for host in newstruct['contacted'].keys():
-                try:
-                    struct['dark'].pop(host)
-                except KeyError:
-                    pass
             for host in newstruct['contacted'].keys():
-                struct['contacted'][host] = newstruct['contacted'][host]
+                struct['dark'].pop(host, None)
+            struct['dark'].update(newstruct['dark'])
+            if callback:
+                callback(newstruct['contacted'])
+            else:
+                struct['contacted'].update(newstruct['contacted'])
 
     return struct
 
 
+def run_concurrently(pattern, retries=0, custom=None, skeleton=False, workers=4, max_forks=50, forks=None,
+                     timeout=5, deadline=None, callback=None, projection=None):
+    """
+    Run the setup module and every custom command concurrently on a bounded pool of workers. The setup
+    module always has a worker of its own, the custom commands share the others. Every custom command gets an
+    equal share of max_forks and the setup module gets what the custom commands running next to it leave,
+    so no more than max_forks are used at the same time. When there are no custom commands, or they aren't
+    run because of skeleton, all of them go to the setup module.
+    Every Ansible run is done in a process of its own with run_in_process, as runners can't run next to each
+    other in the threads of one process.
+
+    When passed a callback, every host is flattened and handed to it as soon as its batch of the setup
+    module completes, instead of being returned. The first batch waits for the custom commands to finish,
+    so only a single batch of hosts is held in memory at any time.
+
+    :param pattern: Host pattern to run on
+    :type pattern: str
+    :param retries: Number of retries to use when host is unreachable or times out
+    :type retries: int
+    :param custom: Dictionary of host pattern to a dictionary of filename to command, as read from an ini
+    :type custom: dict
+    :param skeleton: Whether we are generating a skeleton. If True, don't actually run the custom commands.
+    :type skeleton: bool
+    :param workers: Number of Ansible runs to do at the same time. With a single worker the custom commands
+                    run before the setup module.
+    :type workers: int
+    :param max_forks: Total number of concurrent connections to use
+    :type max_forks: int
+    :param forks: Number of connections the setup module starts with, defaults to all it may use
+    :type forks: int
+    :param timeout: Seconds after which a connection of the setup module times out
+    :type timeout: int
+    :param deadline: Seconds after which the setup module stops starting new batches and retries
+    :type deadline: float
+    :param callback: Called with the name and the flattened structure of every contacted host
+    :type callback: function
+    :param projection: Only keep the parts of every host selected by this projection. Its include pattern is
+                       passed to the setup module as a filter when possible.
+    :type projection: dlib.projection.Projection
+    :return: A tuple of the output of the setup module and the output of the custom commands per filename, as
+             expected by flatten_ansible_struct
+    :rtype: tuple
+    """
+    from multiprocessing.pool import ThreadPool
+
+    custom_runs = []
+    if custom:
+        custom_runs = [(host, filename) for host in custom.keys() for filename in custom[host].keys()]
+    custom_workers = min(len(custom_runs), workers - 1)
+    custom_share = max(1, max_forks // workers)
+    if skeleton:
+        setup_share = max_forks
+    else:
+        setup_share = max(1, max_forks - custom_share * custom_workers)
+    setup_forks = min(forks or setup_share, setup_share)
+
+    pool = ThreadPool(max(1, custom_workers))
+    custom_results = {}
+    for host, filename in custom_runs:
+        custom_results[filename] = pool.apply_async(run_custom_command, (host, custom[host][filename], pattern,
+                                                                         skeleton, custom_share))
+    pool.close()
+    if not custom_workers:
+        pool.join()
+
+    def collect_custom_output():
+        if not custom:
+            return None
+        return dict((filename, result.get()) for filename, result in custom_results.items())
+
+    batch_callback = None
+    if callback:
+        def batch_callback(contacted):
+            custom_output = collect_custom_output()
+            for host, result in contacted.items():
+                if 'ansible_facts' in result:
+                    callback(host, flatten_host(result['ansible_facts'], host_custom_output(custom_output, host),
+                                                projection))
+
+    fact_filter = None
+    if projection:
+        fact_filter = pushdown_filter(projection.include)
+    setup_result = fetch_struct(pattern, retries, setup_forks, timeout, deadline, setup_share, batch_callback,
+                                fact_filter)
+    pool.join()
+
+    return setup_result, collect_custom_output()
+
+
 def gut_struct(struct):
     """
     Given a structure, recursively replace every string with an empty one
@@ -239,16 +505,94 @@ def gut_struct(struct):
             gut_struct(struct[k])
 
 
-def save_struct(jsonfile, struct):
+def list_hosts(pattern):
     """
-    Save the passed structure/dict to json
+    :param pattern: Host pattern to resolve
+    :type pattern: str
+    :return: The names of the hosts in the inventory matching the pattern. Resolved patterns are cached
+             until the inventory changes.
+    :rtype: list
+    """
+    return inventory_cache.hosts(pattern)
+
+
+def in_shard(host, shard, shards):
+    """
+    :param host: Name of the host
+    :type host: str
+    :param shard: Number of the shard, from 1 up to and including shards
+    :type shard: int
+    :param shards: Total number of shards
+    :type shards: int
+    :return: Whether the host belongs to the shard. Hosts are assigned by a hash of their name, so every
+             host ends up in the same shard regardless of the rest of the inventory.
+    :rtype: bool
+    """
+    return int(hashlib.md5(host).hexdigest(), 16) % shards == shard - 1
+
+
+def stale_hosts(pattern, struct, max_age):
+    """
+    Find the hosts matching a pattern which are missing from a structure or were gathered more than
+    max_age seconds ago, according to their ansible_date_time fact.
+
+    :param pattern: Host pattern to check
+    :type pattern: str
+    :param struct: A previously fetched structure
+    :type struct: dict
+    :param max_age: Maximum age in seconds
+    :type max_age: int
+    :return: The names of the hosts to gather again
+    :rtype: list
+    """
+    now = time.time()
+    hosts = []
+    for host in list_hosts(pattern):
+        try:
+            epoch = float(struct[host]['ansible_date_time']['epoch'])
+        except (KeyError, TypeError, ValueError):
+            hosts.append(host)
+            continue
+        if now - epoch > max_age:
+            hosts.append(host)
+
+    return hosts
+
+
+def load_struct(jsonfile):
+    """
+    Load a structure saved with save_struct. Compressed files are detected by their magic bytes and decoded
+    one host at a time while they are decompressed.
+
+    :param jsonfile: Path to the file to read
+    :type jsonfile: str
+    :rtype: dict
+    """
+    if detect_compression(jsonfile):
+        f = open_cache(jsonfile)
+        struct = dict((host, json.loads(data)) for host, data in iter_members(f))
+    else:
+        f = open(jsonfile, 'rb')
+        struct = json.load(f)
+    f.close()
+    return struct
+
+
+def save_struct(jsonfile, struct, compression=None):
+    """
+    Save the passed structure/dict to json. Every host is encoded and written on its own, so the encoded
+    structure is never in memory as a whole. The file is written next to jsonfile and renamed over it once
+    complete, so a mount reloading it never sees half of it.
 
     :param jsonfile: Path to the file to write to
     :type jsonfile: str
     :param struct: structure to save
     :type struct: dict
+    :param compression: One of dlib.compression.COMPRESSIONS to compress the file while it is written
+    :type compression: str
     :rtype: None
     """
-    f = open(jsonfile, 'wb')
-    json.dump(struct, f)
-    f.close()
+    writer = JsonObjectWriter(jsonfile, compression)
+    for host, host_struct in struct.iteritems():
+        writer.write(host, host_struct)
+    writer.close()
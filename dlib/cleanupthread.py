@@ -1,19 +1,46 @@
+import heapq
 import threading
-from time import sleep
-from ansible_helpers import gut_struct
+import time
 
 
 class CleanupThread(threading.Thread):
-    def __init__(self, sleeptime, struct, lock):
+    """
+    Expires realtime data once its time to live has passed. Expiry times are kept in a heap, so every
+    wakeup only touches the entries that are due. The expire function is called with the key of every due
+    entry and should check whether the data was refreshed in the meantime.
+    """
+
+    def __init__(self, expire):
         threading.Thread.__init__(self)
-        self.sleeptime = sleeptime
-        self.struct = struct
+        self.expire = expire
         self.daemon = True
-        self.lock = lock
+        self.heap = []
+        self.condition = threading.Condition()
+
+    def schedule(self, key, when):
+        """
+        :param key: Identifies the data to expire
+        :param when: Time at which the data expires
+        :type when: float
+        """
+        with self.condition:
+            heapq.heappush(self.heap, (when, key))
+            if self.heap[0][1] == key:
+                self.condition.notify()
 
     def run(self):
         while True:
-            self.lock.acquire()
-            gut_struct(self.struct)
-            self.lock.release()
-            sleep(self.sleeptime)
+            with self.condition:
+                while not self.heap:
+                    self.condition.wait()
+                when, key = self.heap[0]
+                delay = when - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.heap)
+
+            try:
+                self.expire(key)
+            except Exception, e:
+                print "Expiring %s failed: %s" % (str(key), e)
@@ -0,0 +1,74 @@
+import bz2
+import gzip
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Magic bytes at the start of a file for every compression
+MAGIC = {
+    'gzip': '\x1f\x8b',
+    'bz2': 'BZh',
+    'lzma': '\xfd7zXZ\x00',
+}
+# Compressions which can be used with this Python
+COMPRESSIONS = ['gzip', 'bz2']
+if lzma is not None:
+    COMPRESSIONS.append('lzma')
+
+
+def detect_compression(filename):
+    """
+    :param filename: Path of the file
+    :type filename: str
+    :return: The compression of the file according to its magic bytes, or None when it isn't compressed
+    :rtype: str
+    """
+    f = open(filename, 'rb')
+    start = f.read(max(len(magic) for magic in MAGIC.values()))
+    f.close()
+    for compression, magic in MAGIC.items():
+        if start.startswith(magic):
+            return compression
+    return None
+
+
+def _open(filename, mode, compression):
+    if compression is None:
+        return open(filename, mode)
+    if compression == 'gzip':
+        return gzip.GzipFile(filename, mode)
+    if compression == 'bz2':
+        return bz2.BZ2File(filename, mode)
+    if compression == 'lzma' and lzma is not None:
+        return lzma.LZMAFile(filename, mode)
+    raise ValueError('Compression %s is not available' % compression)
+
+
+def open_cache(filename):
+    """
+    Open a cache file for reading, decompressing it on the fly when it is compressed
+
+    :param filename: Path of the file
+    :type filename: str
+    :return: A file object returning the uncompressed contents
+    :rtype: file
+    """
+    return _open(filename, 'rb', detect_compression(filename))
+
+
+def create_cache(filename, compression=None):
+    """
+    Open a cache file for writing, compressing what is written on the fly
+
+    :param filename: Path of the file
+    :type filename: str
+    :param compression: One of COMPRESSIONS, or None to write the file uncompressed
+    :type compression: str
+    :return: A file object
+    :rtype: file
+    """
+    return _open(filename, 'wb', compression)
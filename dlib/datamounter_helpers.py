@@ -1,143 +1,434 @@
+import copy
+import itertools
 import json
 import time
 import stat
 import os
 import pwd
+import threading
+from errno import ENOENT
 try:
-    from fuse import Operations
+    from fuse import Operations, FuseOSError
 except ImportError:
-    from local_libs.fuse_local import Operations
-from ansible_helpers import get_real_data, run_custom_command
+    from local_libs.fuse_local import Operations, FuseOSError
+from ansible_helpers import get_real_data, run_custom_command, gut_struct, load_struct, FACT_NAMES
+from cleanupthread import CleanupThread
+from path_index import Node, PathIndex
+from refresher import Refresher
+from reloader import Reloader
 
 
 uid = pwd.getpwuid(os.getuid()).pw_uid
 gid = pwd.getpwuid(os.getuid()).pw_gid
 
+# Directory in the root of the mount exposing statistics of the mount itself
+STATS_DIR = '.datamounter'
+
+
+class HostState(object):
+    """
+    Realtime bookkeeping of a single host. fetch_times and sizes are keyed by the name of the top level fact
+    or custom_commands/$filename for a custom command.
+    """
+    __slots__ = ('fetch_times', 'sizes', 'size', 'read_time', 'in_flight', 'failures', 'retry_time', 'lock')
+
+    def __init__(self):
+        self.fetch_times = {}
+        self.sizes = {}
+        self.size = 0
+        self.read_time = 0
+        self.in_flight = 0
+        self.failures = 0
+        self.retry_time = 0
+        self.lock = threading.Lock()
+
 
 class DataFS(Operations):
-    def __init__(self, struct, realtime=False, utime=10, cleanup=False):
+    def __init__(self, struct, realtime=False, utime=10, cleanup=False, index=None, max_stale=None, forks=10,
+                 batch_window=0.2, expire=60, max_resident=None, projection=None, reload_file=None, load=None,
+                 reload_interval=5, reload_version=None):
         self.cleanup = cleanup
         self.utime = utime
+        self.expire = expire
+        self.max_stale = max_stale
+        self.forks = forks
         self.epoch_time = time.time()
+        self.loaded_time = self.epoch_time
         self.realtime = realtime
-        self.struct = struct
-        self.ctimedict = {}
-        self.fetch_times = {}
+        if index is None:
+            index = PathIndex(struct)
+        self.index = index
+        self.struct = index.struct
+        self.root_mtime = self.epoch_time
+        self.mtimes = {}
+        self.host_states = {}
+        self.max_resident = max_resident
+        self.projection = projection
+        self.resident_bytes = 0
+        self.generations = itertools.count(1)
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.stats = {'generation': lambda: self.generation}
+        if realtime:
+            self.refresher = Refresher(batch_window)
+            self.refresher.start()
+            self.stats['coalesced_refreshes'] = lambda: self.refresher.coalesced
+            self.stats['resident_bytes'] = lambda: self.resident_bytes
         if cleanup:
-            import threading
-            from cleanupthread import CleanupThread
-
-            self.lock = threading.Lock()
-            ct = CleanupThread(3, self.struct, self.lock)
-            ct.run()
-
-    def _recursive_lookup(self, path, struct):
-        if type(struct) == list:
-            newdict = {}
-            for index, i in enumerate(struct):
-                filename = 'listitem_%s' % index
-                newdict[filename] = i
-            struct = newdict
-
-        if len(path) == 0:
-            return struct
-
-        if not type(struct) == dict:
-            return struct
+            self.cleanup_thread = CleanupThread(self._expire)
+            self.cleanup_thread.start()
+        if reload_file:
+            self.reloader = Reloader(reload_file, reload_version, load, self.swap_index, reload_interval)
+            self.reloader.start()
 
+    def _stats_lookup(self, path):
+        name = path.strip('/').partition('/')[2]
+        if not name:
+            return Node(self.stats, ['.', '..'] + self.stats.keys())
         try:
-            newpath = path[1:]
-            return self._recursive_lookup(newpath, struct[path[0]])
+            return Node(self.stats[name]())
         except KeyError:
             return None
 
-    def getattr(self, path, fh=None):
-        splitted_path = split_path(path)
-        val = self._recursive_lookup(splitted_path, self.struct)
+    def _lookup(self, path, index=None):
+        if path.startswith('/' + STATS_DIR) and path.strip('/').partition('/')[0] == STATS_DIR:
+            node = self._stats_lookup(path)
+        else:
+            if index is None:
+                index = self.index
+            node = index.lookup(path)
+        if node is None:
+            raise FuseOSError(ENOENT)
+        return node
 
-        if type(val) == dict:
-            s = stat.S_IFDIR | 0555
+    def swap_index(self, index):
+        """
+        Put a newly loaded index in place of the current one. The new index first takes over the nodes and
+        rendered contents of what didn't change, and only hosts and top level facts which changed get a new
+        modification time, so unchanged files don't look modified. Operations take the index once and use
+        it throughout, so they see either the old or the new index. Data fetched in realtime is forgotten,
+        as the new index replaces it.
+        """
+        old_index = self.index
+        changes = index.adopt(old_index)
+        now = time.time()
+        with self.lock:
+            self.index = index
+            self.struct = index.struct
+            self.host_states = {}
+            self.resident_bytes = 0
+            for host, names in changes.iteritems():
+                if names is None:
+                    self.mtimes.pop(host, None)
+                    continue
+                times = self.mtimes.setdefault(host, {})
+                for name in names:
+                    times[name] = now
+            if not set(index.host_names()) == set(old_index.host_names()):
+                self.root_mtime = now
+            self.loaded_time = now
+            self.generation = next(self.generations)
+        print "Reloaded %s changed hosts" % len(changes)
+
+    def _mtime(self, path):
+        """
+        :return: When the host or top level fact the path is in last changed in a reload, or the time the
+                 filesystem was mounted when it didn't since
+        :rtype: float
+        """
+        splitted_path = path.strip('/').split('/', 2)
+        if not splitted_path[0]:
+            return self.root_mtime
+        times = self.mtimes.get(splitted_path[0])
+        if times is None:
+            return self.epoch_time
+        if len(splitted_path) > 1:
+            name = splitted_path[1]
         else:
-            s = stat.S_IFREG | 0444
+            name = ''
+        return times.get(name, self.epoch_time)
 
-        size = len(str(val)) + 1
+    def _state(self, host):
+        state = self.host_states.get(host)
+        if state is None:
+            state = self.host_states.setdefault(host, HostState())
+        return state
 
-        try:
-            ctime = self.ctimedict[str(path)]
-        except KeyError:
-            ctime = self.epoch_time
+    def _merge_host(self, host, keys, value=None, remove=False):
+        """
+        Put value at the path given by keys within a host, or remove what is there. The dictionaries along
+        the path are copied and the new host is swapped in as a whole, so readers never need a lock. Every
+        swap increases the generation of the mount.
+        """
+        with self._state(host).lock:
+            index = self.index
+            try:
+                host_struct = dict(self._lookup(host, index).value)
+            except FuseOSError:
+                return
 
-        return {'st_ctime': self.epoch_time, 'st_mtime': ctime, 'st_mode': s, 'st_size': size, 'st_gid': gid,
-                'st_uid': uid, 'st_atime': 1.1}
+            parent = host_struct
+            for key in keys[:-1]:
+                parent[key] = dict(parent.get(key, {}))
+                parent = parent[key]
+            if remove:
+                parent.pop(keys[-1], None)
+            else:
+                parent[keys[-1]] = value
+            index.replace_host(host, host_struct)
+            self.generation = next(self.generations)
 
-    def readdir(self, path, fh):
-        dirents = ['.', '..']
-        splitted_path = split_path(path)
-        path_tip = self._recursive_lookup(splitted_path, self.struct)
+    def _fetched(self, host, name, value):
+        """
+        Record a refresh of name and account for the size of the value fetched. When that brings the data
+        fetched over max_resident bytes, the least recently read hosts are emptied again.
+        """
+        now = time.time()
+        size = len(json.dumps(value))
+        state = self._state(host)
+        with self.lock:
+            state.fetch_times[name] = now
+            state.failures = 0
+            difference = size - state.sizes.get(name, 0)
+            state.sizes[name] = size
+            state.size += difference
+            self.resident_bytes += difference
+
+            if self.max_resident is not None and self.resident_bytes > self.max_resident:
+                self._evict(host)
+
+        if self.cleanup:
+            self.cleanup_thread.schedule((host, name), now + self.expire)
+
+    def _failed(self, host):
+        """
+        Back off from refreshing a host which could not be reached, doubling the delay on every failure
+        """
+        state = self._state(host)
+        state.failures += 1
+        state.retry_time = time.time() + self.utime * min(2 ** state.failures, 32)
 
-        if len(splitted_path) == 0:
-            dirents.extend(self.struct.keys())
-            for r in dirents:
-                yield r
+    def _evict(self, keep):
+        """
+        Empty the data fetched for the least recently read hosts until it fits in max_resident bytes again,
+        never evicting the host keep or hosts being refreshed. Needs to be called with the lock held.
+        """
+        candidates = sorted((state.read_time, host) for host, state in self.host_states.items()
+                            if state.size and not state.in_flight and not host == keep)
+        for _, host in candidates:
+            if self.resident_bytes <= self.max_resident:
+                break
 
+            state = self.host_states[host]
+            for name in state.sizes.keys():
+                del state.fetch_times[name]
+                self._empty(host, name)
+            self.resident_bytes -= state.size
+            state.sizes.clear()
+            state.size = 0
+
+    def _empty(self, host, name):
+        """
+        Empty the values fetched for name, leaving only the structure
+        """
+        try:
+            value = self._lookup('/%s/%s' % (host, name)).value
+        except FuseOSError:
+            return
+
+        if type(value) == dict:
+            value = copy.deepcopy(value)
+            gut_struct(value)
         else:
-            dirents.extend(path_tip.keys())
-            for r in dirents:
-                yield r
+            value = ''
+        self._merge_host(host, name.split('/'), value)
 
-    def read(self, path, length, offset, fh):
-        splitted_path = split_path(path)
-        host = splitted_path[0]
-        if host not in self.fetch_times.keys():
-            self.fetch_times[host] = 0
+    def _expire(self, key):
+        """
+        Empty the values fetched for key, unless they were refreshed after being scheduled for expiry
+        """
+        host, name = key
+        state = self._state(host)
+        with self.lock:
+            try:
+                if time.time() - state.fetch_times[name] < self.expire:
+                    return
+            except KeyError:
+                return
+            del state.fetch_times[name]
 
-        if self.realtime:
-            if self.cleanup:
-                self.lock.acquire()
+            size = state.sizes.pop(name)
+            state.size -= size
+            self.resident_bytes -= size
 
-            if "custom_commands" not in splitted_path:
-                try:
-                    old_custom_commands = self.struct[host]['custom_commands']
-                except KeyError:
-                    old_custom_commands = None
+        self._empty(host, name)
 
-                if int(time.time() - self.fetch_times[host]) < self.utime:
-                    pass
+    def _project(self, name, value):
+        """
+        Apply the projection the mount was loaded with to a value fetched for name, so refreshes don't bring
+        back what was left out. Returns whether anything of the value is kept and what is kept.
+        """
+        if not self.projection:
+            return True, value
 
-                else:
-                    if host in self.struct.keys():
-                        current_host_data = get_real_data(host, old_custom_commands)
-                        self.struct[host] = current_host_data[host]
-                        self.fetch_times[host] = time.time()
+        keys = name.split('/')
+        for key in reversed(keys):
+            value = {key: value}
+        value = self.projection.apply(value)
+        for key in keys:
+            try:
+                value = value[key]
+            except KeyError:
+                return False, None
+        return True, value
 
-            elif 'stdout' in splitted_path:
-                if self.cleanup:
-                    self.lock.acquire()
+    def _refresh_facts(self, facts):
+        hosts_per_fact = {}
+        for host, fact in facts:
+            hosts_per_fact.setdefault(fact, []).append(host)
 
-                if int(time.time() - self.fetch_times[host]) < self.utime:
-                    pass
+        for fact, hosts in hosts_per_fact.items():
+            for host in hosts:
+                self._state(host).in_flight += 1
+            try:
+                current_host_data = get_real_data(hosts, forks=min(self.forks, len(hosts)),
+                                                  fact_filter=FACT_NAMES.get(fact, fact))
+            except Exception:
+                for host in hosts:
+                    self._failed(host)
+                raise
+            finally:
+                for host in hosts:
+                    self._state(host).in_flight -= 1
+
+            for host in hosts:
+                if host not in current_host_data:
+                    self._failed(host)
+                    continue
+                value = current_host_data[host].get(fact)
+                keep = fact in current_host_data[host]
+                if keep:
+                    keep, value = self._project(fact, value)
+                if keep:
+                    self._merge_host(host, [fact], value)
                 else:
-                    splitted_cmd_path = splitted_path[:splitted_path.index('custom_commands') + 2]
-                    filename = splitted_cmd_path[-1:][0]
-                    splitted_cmd_path.append('cmd')
-                    cmd = str(self._recursive_lookup(splitted_cmd_path, self.struct)) + "\n"
-                    output = {host: run_custom_command(host, cmd)}[host]['contacted']
-                    self.struct[host]['custom_commands'][filename] = output[host]
-                    self.fetch_times[host] = time.time()
+                    self._merge_host(host, [fact], remove=True)
+                self._fetched(host, fact, value)
 
-        if self.cleanup:
-            self.lock.release()
+    def _refresh_custom_commands(self, commands):
+        for host, name in commands:
+            cmd = str(self._lookup('/%s/%s/cmd' % (host, name)).value) + "\n"
+            output = run_custom_command(host, cmd, host)
+            if not output or host not in output.get('contacted', {}):
+                self._failed(host)
+                continue
+            keep, value = self._project(name, output['contacted'][host])
+            self._merge_host(host, name.split('/'), value, remove=not keep)
+            self._fetched(host, name, value)
+
+    def _known_since(self, host, name):
+        """
+        :return: Since when the value of name the index was loaded with is known: the time the host was
+                 gathered according to its ansible_date_time fact, or else the time the index was loaded.
+                 None when there is no value, because the cache is a skeleton or the value was emptied.
+        :rtype: float
+        """
+        index = self.index
+        try:
+            value = self._lookup('/%s/%s' % (host, name), index).value
+        except FuseOSError:
+            return None
+        if not has_values(value):
+            return None
+        try:
+            return float(self._lookup('/%s/ansible_date_time/epoch' % host, index).value)
+        except (FuseOSError, TypeError, ValueError):
+            return self.loaded_time
+
+    def _revalidate(self, splitted_path):
+        """
+        Refresh the data behind a path once it is older than utime. Only the top level fact the path is in
+        is gathered again and merged into the host. The refresh runs in the background and the read is
+        answered with the last known value, unless that value is older than max_stale. Values from the cache
+        count as fetched when the host was gathered. Only when there is no value, because the cache is a
+        skeleton or the value was emptied since because it expired or was evicted, the read waits for the
+        refresh. Stale hosts requested within batch_window of each other are
+        refreshed in one Ansible run per fact. Reads also keep track of which hosts were read least recently,
+        for when the data fetched exceeds max_resident.
+
+        This runs without taking the DataFS lock: the bookkeeping only consists of attribute and dictionary
+        reads and writes on the HostState of the host, and refreshes swap in complete hosts.
+        """
+        host = splitted_path[0]
+        if len(splitted_path) < 2 or host == STATS_DIR:
+            return
+
+        if not splitted_path[1] == 'custom_commands':
+            name = splitted_path[1]
+            refresh = self._refresh_facts
+        elif splitted_path[-1] == 'stdout' and len(splitted_path) > 3:
+            name = 'custom_commands/' + splitted_path[2]
+            refresh = self._refresh_custom_commands
+        else:
+            return
+
+        state = self._state(host)
+        now = time.time()
+        state.read_time = now
+        if now < state.retry_time:
+            return
+        try:
+            fetched = state.fetch_times[name]
+        except KeyError:
+            fetched = self._known_since(host, name)
+            if fetched is None:
+                self.refresher.refresh((host, name), refresh, (host, name))
+                return
+            fetched = state.fetch_times.setdefault(name, fetched)
+        age = now - fetched
+        if age < self.utime:
+            return
+        if self.max_stale is None or age < self.max_stale:
+            self.refresher.request((host, name), refresh, (host, name))
+        else:
+            self.refresher.refresh((host, name), refresh, (host, name))
+
+    def getattr(self, path, fh=None):
+        index = self.index
+        node = self._lookup(path, index)
+
+        if node.is_dir:
+            s = stat.S_IFDIR | 0555
+            size = 0
+        else:
+            s = stat.S_IFREG | 0444
+            size = index.size(path, node)
+
+        mtime = self._mtime(path)
+        return {'st_ctime': mtime, 'st_mtime': mtime, 'st_mode': s, 'st_size': size, 'st_gid': gid,
+                'st_uid': uid, 'st_atime': 1.1}
+
+    def readdir(self, path, fh):
+        if path == '/':
+            return self.index.root.children + [STATS_DIR]
+        return self._lookup(path).children
+
+    def read(self, path, length, offset, fh):
+        if self.realtime:
+            self._revalidate(split_path(path))
 
-        path_tip = str(self._recursive_lookup(splitted_path, self.struct)) + "\n"
-        r = path_tip[offset:offset + length]
-        return r
+        index = self.index
+        return index.read(path, self._lookup(path, index), offset, length)
 
 
-def load_struct(pklfile):
-    f = open(pklfile, 'rb')
-    struct = json.load(f)
-    f.close()
-    return struct
+def has_values(value):
+    """
+    :return: Whether anything is left of a value besides the structure gut_struct leaves of it
+    :rtype: bool
+    """
+    if type(value) == dict:
+        return any(has_values(item) for key, item in value.iteritems() if not key == 'cmd')
+    return not value == ''
 
 
 def split_path(path):
@@ -0,0 +1,78 @@
+import random
+
+
+class ForkTuner(object):
+    """
+    Tunes the number of forks used for a gather from the batches completed so far. The forks are the number
+    of hosts being gathered at the same time, spread over overlap batches which run next to each other with
+    a fork per host, so a batch waiting for its slowest host doesn't hold up the others. While hosts answer
+    well within the timeout and the throughput keeps up, the number of forks is increased step by step. When
+    a large part of a batch goes dark or hosts take most of the timeout to answer, the number of forks is
+    halved, as that usually means the control machine or the network is saturated. Only batches started
+    after the last adjustment are taken into account for the next one.
+    """
+
+    def __init__(self, forks, timeout, min_forks=5, max_forks=None, step=5, dark_limit=0.2, overlap=4):
+        self.forks = forks
+        self.timeout = timeout
+        self.min_forks = min(min_forks, forks)
+        if max_forks is None:
+            max_forks = forks * 4
+        self.max_forks = max_forks
+        self.step = step
+        self.dark_limit = dark_limit
+        self.overlap = overlap
+        self.best_rate = 0
+        self.version = 0
+
+    def batch_size(self):
+        """
+        :return: Number of hosts to put in the next batch
+        :rtype: int
+        """
+        return max(1, self.forks // self.overlap)
+
+    def record(self, hosts, dark, elapsed, version=None):
+        """
+        Adjust the number of forks after a batch
+
+        :param hosts: Number of hosts in the batch, each of which had a fork of its own
+        :type hosts: int
+        :param dark: Number of hosts in the batch which were unreachable or timed out
+        :type dark: int
+        :param elapsed: Seconds the batch took
+        :type elapsed: float
+        :param version: The version of the tuner when the batch was started. Batches started before the last
+                        adjustment are ignored.
+        :type version: int
+        :return: The number of forks to use for the next batches
+        :rtype: int
+        """
+        if version is not None and not version == self.version:
+            return self.forks
+
+        elapsed = max(elapsed, 0.001)
+        # The throughput of all forks if every host takes as long as the hosts of this batch
+        rate = (hosts - dark) * self.forks / (hosts * elapsed)
+
+        forks = self.forks
+        # A batch with dark hosts always takes the timeout, so only batches without them tell the latency
+        slow = not dark and elapsed > self.timeout / 2.0
+        if dark > hosts * self.dark_limit or slow:
+            self.forks = max(self.min_forks, self.forks // 2)
+        elif rate >= self.best_rate:
+            self.forks = min(self.max_forks, self.forks + self.step)
+        self.best_rate = max(self.best_rate, rate)
+        if not self.forks == forks:
+            self.version += 1
+        return self.forks
+
+
+def backoff_delay(attempt, base=1, cap=30):
+    """
+    :param attempt: Number of the retry, starting at 0
+    :type attempt: int
+    :return: Seconds to wait before a retry: exponential backoff with full jitter
+    :rtype: float
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,83 @@
+import os
+import threading
+
+import ansible.constants
+import ansible.inventory
+
+
+def inventory_mtime(path):
+    """
+    :param path: Path of the inventory, either a file or a directory of inventory files
+    :type path: str
+    :return: The latest modification time of the inventory, or None when it doesn't exist
+    :rtype: float
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+
+    if os.path.isdir(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in dirnames + filenames:
+                try:
+                    mtime = max(mtime, os.stat(os.path.join(dirpath, name)).st_mtime)
+                except OSError:
+                    pass
+    return mtime
+
+
+class InventoryCache(object):
+    """
+    Keeps a parsed Ansible inventory and the hosts every pattern resolved to, so the inventory is parsed
+    once instead of for every Runner and every pattern. Both are thrown away as soon as the modification
+    time of the inventory changes. Inventory scripts are cached the same way, so their output is only
+    picked up again once the script itself changes.
+    """
+
+    def __init__(self, host_list=None):
+        if host_list is None:
+            host_list = ansible.constants.DEFAULT_HOST_LIST
+        self.host_list = host_list
+        self.mtime = None
+        self.parsed = None
+        self.patterns = {}
+        self.lock = threading.Lock()
+
+    def _current(self):
+        mtime = inventory_mtime(os.path.expanduser(self.host_list))
+        with self.lock:
+            if self.parsed is None or not mtime == self.mtime:
+                self.parsed = ansible.inventory.Inventory(self.host_list)
+                self.patterns = {}
+                self.mtime = mtime
+            return self.parsed, self.patterns
+
+    def inventory(self):
+        """
+        :return: The parsed inventory, parsed again when the inventory changed
+        :rtype: ansible.inventory.Inventory
+        """
+        return self._current()[0]
+
+    def hosts(self, pattern):
+        """
+        :param pattern: Host pattern to resolve, or a list of patterns
+        :type pattern: str or list
+        :return: The names of the hosts matching the pattern
+        :rtype: list
+        """
+        inventory, patterns = self._current()
+        if type(pattern) == list:
+            key = tuple(pattern)
+        else:
+            key = pattern
+        try:
+            return list(patterns[key])
+        except KeyError:
+            hosts = [i.name for i in inventory.get_hosts(pattern)]
+            patterns[key] = hosts
+            return list(hosts)
+
+
+inventory_cache = InventoryCache()
@@ -0,0 +1,70 @@
+import json
+import os
+
+
+class Journal(object):
+    """
+    Checkpoint of a fetch in the json lines format. The first line is a header describing the run, every
+    following line holds a host and its structure. A journal with the same header is resumed: the hosts in
+    it are kept and only the remaining hosts need to be gathered. A line cut off by an interruption is
+    dropped.
+    """
+
+    def __init__(self, filename, header):
+        self.filename = filename
+        self.done = set()
+
+        end = 0
+        try:
+            f = open(filename, 'rb')
+            line = f.readline()
+            if line.endswith('\n') and json.loads(line) == header:
+                end = f.tell()
+                for line in iter(f.readline, ''):
+                    if not line.endswith('\n'):
+                        break
+                    self.done.add(json.loads(line)['host'])
+                    end = f.tell()
+            f.close()
+        except (IOError, ValueError, KeyError):
+            pass
+
+        if end:
+            self.f = open(filename, 'r+b')
+            self.f.truncate(end)
+            self.f.seek(end)
+        else:
+            self.f = open(filename, 'wb')
+            self.f.write(json.dumps(header) + '\n')
+            self.f.flush()
+
+    def write(self, host, struct):
+        """
+        Record a gathered host
+
+        :param host: Name of the host
+        :type host: str
+        :param struct: The flattened structure of the host
+        :type struct: dict
+        """
+        self.f.write(json.dumps({'host': host, 'struct': struct}) + '\n')
+        self.f.flush()
+        self.done.add(host)
+
+    def close(self):
+        self.f.close()
+
+    def entries(self):
+        """
+        :return: Generator of (host, structure) tuples of every host in the journal
+        :rtype: generator
+        """
+        f = open(self.filename, 'rb')
+        f.readline()
+        for line in f:
+            entry = json.loads(line)
+            yield entry['host'], entry['struct']
+        f.close()
+
+    def remove(self):
+        os.remove(self.filename)
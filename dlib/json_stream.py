@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+
+from compression import create_cache
+from lazy_json import scan_object
+
+
+def digest(data):
+    """
+    :param data: A json encoded value
+    :type data: str
+    :return: A short digest of the encoded value
+    :rtype: str
+    """
+    return hashlib.md5(data).hexdigest()[:16]
+
+
+class JsonObjectWriter(object):
+    """
+    Writes a json object one member at a time, so the members don't have to be in memory together. The
+    object is written next to filename and renamed over it once closed. Next to it $filename.digests is
+    written, a json object with for every member the md5 of its encoded value under the key '' and a
+    digest of the value of every top level name within it, which tells a reload what changed without
+    decoding anything. The digests file is renamed into place first, so it may be newer than the object
+    it is next to; check the md5 before using the other digests.
+    """
+
+    def __init__(self, filename, compression=None):
+        self.filename = filename
+        self.partial_file = filename + '.partial'
+        self.f = create_cache(self.partial_file, compression)
+        self.f.write('{')
+        self.digests = open(self.partial_file + '.digests', 'wb')
+        self.digests.write('{')
+        self.keys = set()
+
+    def write(self, key, value):
+        """
+        :param key: Name of the member
+        :type key: str
+        :param value: Value of the member, anything json serializable
+        """
+        if not type(value) == dict:
+            self._write(key, json.dumps(value), {})
+            return
+
+        members = [(name, json.dumps(item)) for name, item in sorted(value.iteritems())]
+        data = '{%s}' % ', '.join('%s: %s' % (json.dumps(name), encoded) for name, encoded in members)
+        self._write(key, data, dict((name, digest(encoded)) for name, encoded in members))
+
+    def write_raw(self, key, data):
+        """
+        Like write, but with a value which is already json encoded
+
+        :param key: Name of the member
+        :type key: str
+        :param data: The json encoded value
+        :type data: str
+        """
+        digests = {}
+        if data.lstrip().startswith('{'):
+            digests = dict((name, digest(data[start:end])) for name, start, end in scan_object(data))
+        self._write(key, data, digests)
+
+    def _write(self, key, data, digests):
+        if self.keys:
+            separator = ','
+        else:
+            separator = ''
+        encoded_key = json.dumps(key)
+        self.f.write('%s\n%s: %s' % (separator, encoded_key, data))
+        digests[''] = hashlib.md5(data).hexdigest()
+        self.digests.write('%s\n%s: %s' % (separator, encoded_key, json.dumps(digests)))
+        self.keys.add(key)
+
+    def close(self):
+        self.f.write('\n}\n')
+        self.f.close()
+        self.digests.write('\n}\n')
+        self.digests.close()
+        os.rename(self.partial_file + '.digests', self.filename + '.digests')
+        os.rename(self.partial_file, self.filename)
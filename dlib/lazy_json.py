@@ -0,0 +1,425 @@
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import re
+import threading
+
+from compression import detect_compression, open_cache
+from path_index import Node, PathIndex, build_host_index, materialize_lists
+
+WHITESPACE = re.compile(r'\s*')
+STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+# Everything up to the next bracket that is not inside a string
+NO_BRACKETS = re.compile(r'[^"{}\[\]]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"{}\[\]]*)*')
+SCALAR = re.compile(r'[^,}\]\s]+')
+# A key with the colon following it, and the separator following a value
+MEMBER = re.compile(r'\s*("[^"\\]*(?:\\.[^"\\]*)*")\s*:\s*')
+SEPARATOR = re.compile(r'\s*([,}])')
+# Number of bytes read at a time when streaming a json object from a file
+CHUNK_SIZE = 1 << 20
+
+
+def _skip_whitespace(buf, pos):
+    return WHITESPACE.match(buf, pos).end()
+
+
+def _decode_key(raw):
+    if '\\' in raw:
+        return json.loads(raw)
+    return raw[1:-1].decode('utf-8')
+
+
+def skip_value(buf, pos):
+    """
+    Find the end of the json value starting at pos without decoding it
+
+    :param buf: The json document
+    :type buf: str or mmap.mmap
+    :param pos: Offset of the first character of the value
+    :type pos: int
+    :return: Offset just after the value
+    :rtype: int
+    """
+    char = buf[pos]
+    if char == '"':
+        return STRING.match(buf, pos).end()
+    if char not in '{[':
+        return SCALAR.match(buf, pos).end()
+
+    depth = 0
+    while True:
+        char = buf[pos]
+        if char in '{[':
+            depth += 1
+        elif char in '}]':
+            depth -= 1
+            if depth == 0:
+                return pos + 1
+        else:
+            raise ValueError('Invalid json at offset %s' % pos)
+        pos = NO_BRACKETS.match(buf, pos + 1).end()
+
+
+def _scan_members(buf, pos):
+    pos = _skip_whitespace(buf, pos)
+    if not buf[pos] == '{':
+        raise ValueError('Expected a json object at offset %s' % pos)
+
+    pos = _skip_whitespace(buf, pos + 1)
+    if buf[pos] == '}':
+        return
+
+    while True:
+        match = MEMBER.match(buf, pos)
+        if match is None:
+            raise ValueError('Expected a key at offset %s' % pos)
+        start = match.end()
+        end = skip_value(buf, start)
+        yield pos, match.group(1), start, end
+
+        match = SEPARATOR.match(buf, end)
+        if match is None:
+            raise ValueError('Expected "," or "}" at offset %s' % end)
+        if match.group(1) == '}':
+            return
+        pos = match.end()
+
+
+def scan_object(buf, pos=0):
+    """
+    Walk the members of the json object starting at pos without decoding their values
+
+    :param buf: The json document
+    :type buf: str or mmap.mmap
+    :param pos: Offset of the object, leading whitespace is allowed
+    :type pos: int
+    :return: Generator of (key, value_start, value_end) tuples
+    :rtype: generator
+    """
+    for _, key, start, end in _scan_members(buf, pos):
+        yield _decode_key(key), start, end
+
+
+def _next_member(buf, pos, first):
+    if first:
+        pos = _skip_whitespace(buf, pos)
+        if not buf[pos] == '{':
+            raise ValueError('Expected a json object at offset %s' % pos)
+        pos = _skip_whitespace(buf, pos + 1)
+        if buf[pos] == '}':
+            return None, None, None, None
+
+    match = MEMBER.match(buf, pos)
+    start = match.end()
+    end = skip_value(buf, start)
+    separator = SEPARATOR.match(buf, end)
+    if separator.group(1) == '}':
+        return match.group(1), start, end, None
+    return match.group(1), start, end, separator.end()
+
+
+def iter_members(f, chunk_size=CHUNK_SIZE):
+    """
+    Read the members of the json object in a file one at a time, so only a single member and a chunk of
+    the file are in memory at any time. Works with any file object, such as a decompressing one.
+
+    :param f: The opened file
+    :type f: file
+    :param chunk_size: Number of bytes to read at a time
+    :type chunk_size: int
+    :return: Generator of (key, json encoded value) tuples
+    :rtype: generator
+    """
+    buf = ''
+    pos = 0
+    first = True
+    while True:
+        try:
+            raw_key, start, end, next_pos = _next_member(buf, pos, first)
+        except (IndexError, AttributeError, ValueError):
+            # The member isn't read completely yet
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise ValueError('Invalid or truncated json object')
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+
+        first = False
+        if raw_key is None:
+            return
+        yield _decode_key(raw_key), buf[start:end]
+        if next_pos is None:
+            return
+        pos = next_pos
+
+
+def decode_projected(buf, pos, projection, prefix='', included=False):
+    """
+    Decode the json object of a host starting at pos, keeping only what the projection selects. Excluded
+    values and values outside of the included paths are skipped over without being decoded.
+
+    :param buf: The json document
+    :type buf: str or mmap.mmap
+    :param pos: Offset of the object
+    :type pos: int
+    :param projection: Selects what to keep
+    :type projection: dlib.projection.Projection
+    :param prefix: Path of the object within the host, ending in a slash
+    :type prefix: str
+    :param included: Whether the object is in an included directory
+    :type included: bool
+    :return: The decoded object, with only what is kept
+    :rtype: dict
+    """
+    # Members kept as a whole are gathered into a single json object, so they are decoded in one go.
+    # Consecutive kept members are copied as one run.
+    kept = []
+    run_start = run_end = None
+    walked = {}
+    for member_start, raw_key, start, end in _scan_members(buf, pos):
+        key = _decode_key(raw_key)
+        path = prefix + key
+        if projection.excluded(path):
+            keep = False
+        else:
+            keep = included or projection.included(path)
+            if buf[start] == '{' and projection.walk(path, keep):
+                value = decode_projected(buf, start, projection, path + '/', keep)
+                if keep or value:
+                    walked[key] = value
+                keep = False
+
+        if keep:
+            if run_start is None:
+                run_start = member_start
+            run_end = end
+        elif run_start is not None:
+            kept.append(buf[run_start:run_end])
+            run_start = None
+    if run_start is not None:
+        kept.append(buf[run_start:run_end])
+
+    if kept:
+        result = json.loads('{%s}' % ','.join(kept))
+        result.update(walked)
+        return result
+    return walked
+
+
+def load_projected(filename, projection):
+    """
+    Load a json cache, only decoding what the projection selects of every host
+
+    :param filename: Path of the cache file
+    :type filename: str
+    :param projection: Selects what to keep of every host
+    :type projection: dlib.projection.Projection
+    :return: Dictionary of host to its projected structure
+    :rtype: dict
+    """
+    struct = {}
+    if detect_compression(filename):
+        f = open_cache(filename)
+        for host, data in iter_members(f):
+            struct[host] = decode_projected(data, 0, projection)
+        f.close()
+        return struct
+
+    f = open(filename, 'rb')
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    f.close()
+    for host, start, end in scan_object(mm):
+        struct[host] = decode_projected(mm, start, projection)
+    mm.close()
+    return struct
+
+
+def load_offsets(filename, mm, persist=False):
+    """
+    Get the byte range of every host in a json cache. When persist is set, the ranges are saved next to the
+    cache and reused as long as the size and mtime of the cache don't change.
+
+    :param filename: Path of the cache file
+    :type filename: str
+    :param mm: The mapped cache file
+    :type mm: mmap.mmap
+    :param persist: Whether to use and save an offset file
+    :type persist: bool
+    :return: Dictionary of host to a (start, end) tuple
+    :rtype: dict
+    """
+    offsets_file = filename + '.offsets'
+    st = os.stat(filename)
+    if persist:
+        try:
+            f = open(offsets_file, 'rb')
+            saved = json.load(f)
+            f.close()
+            if saved['size'] == st.st_size and saved['mtime'] == st.st_mtime:
+                return dict((host, tuple(r)) for host, r in saved['hosts'].iteritems())
+        except (IOError, ValueError, KeyError):
+            pass
+
+    offsets = dict((host, (start, end)) for host, start, end in scan_object(mm))
+
+    if persist:
+        try:
+            f = open(offsets_file, 'wb')
+            json.dump({'size': st.st_size, 'mtime': st.st_mtime, 'hosts': offsets}, f)
+            f.close()
+        except IOError:
+            pass
+
+    return offsets
+
+
+def _map_digests(filename):
+    """
+    :return: The digests file written next to a cache by JsonObjectWriter, mapped so it keeps referring to
+             the same file when a new version is renamed over it, or None when there is none
+    :rtype: mmap.mmap
+    """
+    try:
+        f = open(filename + '.digests', 'rb')
+    except IOError:
+        return None
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (mmap.error, ValueError):
+        return None
+    finally:
+        f.close()
+
+
+class LazyIndex(PathIndex):
+    """
+    PathIndex over a json cache which only decodes a host once it is accessed. At most max_hosts decoded
+    hosts stay resident, the least recently used ones are dropped and decoded again on their next access.
+    Every lookup of a resident host records a sequence number for the access, which is all it takes to
+    keep track of the least recently used ones without a lock. Hosts replaced by a realtime refresh don't
+    count towards max_hosts and are never dropped, as they can't be decoded again from the cache; the
+    memory they take is bounded by the max_resident of DataFS instead. When passed a Projection, only what
+    it selects of a host is decoded.
+    """
+
+    def __init__(self, filename, max_hosts=256, persist_offsets=False, transform=None, renders=None,
+                 projection=None):
+        f = open(filename, 'rb')
+        self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        self.offsets = load_offsets(filename, self.mm, persist_offsets)
+        self.digests = _map_digests(filename)
+        self.digest_offsets = None
+        self.max_hosts = max_hosts
+        self.transform = transform
+        self.projection = projection
+        self.resident = {}
+        self.accesses = itertools.count()
+        self.replaced = set()
+        self.load_lock = threading.Lock()
+        PathIndex.__init__(self, {}, renders)
+
+    def _update_root(self):
+        names = self.offsets.keys()
+        names.extend(host for host in self.struct.keys() if host not in self.offsets)
+        self.root = Node(self.struct, ['.', '..'] + names)
+
+    def _touch(self, host):
+        self.resident[host] = next(self.accesses)
+        while len(self.resident) > self.max_hosts:
+            old_host = min(self.resident, key=self.resident.get)
+            del self.resident[old_host]
+            self.hosts.pop(old_host, None)
+            self.struct.pop(old_host, None)
+            self.renders.invalidate_host(old_host)
+
+    def _load_host(self, host):
+        with self.load_lock:
+            try:
+                return self.hosts[host]
+            except KeyError:
+                pass
+
+            start, end = self.offsets[host]
+            if self.projection:
+                struct = decode_projected(self.mm, start, self.projection)
+            else:
+                struct = json.loads(self.mm[start:end])
+            if self.transform:
+                self.transform(struct)
+            struct = materialize_lists(struct)
+            self.struct[host] = struct
+            self.hosts[host] = build_host_index(struct)
+            self._touch(host)
+            return self.hosts[host]
+
+    def lookup(self, path):
+        path = path.strip('/')
+        if not path:
+            return self.root
+
+        host, _, rest = path.partition('/')
+        try:
+            host_index = self.hosts[host]
+        except KeyError:
+            if host not in self.offsets:
+                return None
+            host_index = self._load_host(host)
+        else:
+            if host in self.resident:
+                self.resident[host] = next(self.accesses)
+        return host_index.get(rest)
+
+    def host_digest(self, host):
+        """
+        :return: The md5 of the encoded host in the cache, which doesn't need the host to be decoded. None
+                 when the host was replaced since.
+        :rtype: str
+        """
+        if host in self.replaced:
+            return None
+        start, end = self.offsets[host]
+        return hashlib.md5(self.mm[start:end]).hexdigest()
+
+    def fact_digests(self, host):
+        """
+        :return: The digests of the top level facts of a host from the digests file written next to the
+                 cache, or None when the host was replaced since, or the digests file is missing or was
+                 written for another version of the host
+        :rtype: dict
+        """
+        if host in self.replaced or self.digests is None:
+            return None
+        if self.digest_offsets is None:
+            self.digest_offsets = dict((name, (start, end)) for name, start, end in scan_object(self.digests))
+        try:
+            start, end = self.digest_offsets[host]
+        except KeyError:
+            return None
+
+        digests = json.loads(self.digests[start:end])
+        if not digests.pop('', None) == self.host_digest(host):
+            return None
+        return digests
+
+    def host_struct(self, host):
+        return self.lookup(host).value
+
+    def _host_index(self, host):
+        # Only called for hosts which were decoded in the index this one replaces, so they are likely to be
+        # accessed again anyway
+        return self._load_host(host)
+
+    def _adopt_host(self, host, host_index):
+        with self.load_lock:
+            PathIndex._adopt_host(self, host, host_index)
+            self._touch(host)
+
+    def replace_host(self, host, struct):
+        with self.load_lock:
+            PathIndex.replace_host(self, host, struct)
+            self.replaced.add(host)
+            self.resident.pop(host, None)
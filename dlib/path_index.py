@@ -0,0 +1,293 @@
+from render_cache import RenderCache
+
+
+class Node(object):
+    """
+    A single entry in the mounted tree. Directories carry their precomputed directory listing in
+    ``children``, files have ``children`` set to None. ``rendered`` is filled in by the RenderCache.
+    """
+    __slots__ = ('value', 'children', 'rendered')
+
+    def __init__(self, value, children=None):
+        self.value = value
+        self.children = children
+        self.rendered = None
+
+    @property
+    def is_dir(self):
+        return self.children is not None
+
+
+def materialize_lists(struct):
+    """
+    Recursively replace every list in the structure by a dictionary with a listitem_N key per item, so
+    lists can be served as directories without converting them on every request.
+
+    :param struct: The structure to convert. Dictionaries are modified in place
+    :type struct: dict
+    :return: The converted structure
+    :rtype: dict
+    """
+    if type(struct) == list:
+        struct = dict(('listitem_%s' % index, item) for index, item in enumerate(struct))
+
+    if type(struct) == dict:
+        for k, v in struct.items():
+            if type(v) == list or type(v) == dict:
+                struct[k] = materialize_lists(v)
+
+    return struct
+
+
+def build_host_index(struct):
+    """
+    Walk a host subtree once and map every relative path in it to its Node. The host itself is stored
+    under the empty path.
+
+    :param struct: The subtree of a single host, with its lists materialized
+    :type struct: dict
+    :return: Dictionary of relative path to Node
+    :rtype: dict
+    """
+    index = {}
+    stack = [('', struct)]
+    while stack:
+        path, value = stack.pop()
+        if path:
+            prefix = path + '/'
+        else:
+            prefix = ''
+
+        if not type(value) == dict:
+            index[path] = Node(value)
+            continue
+
+        index[path] = Node(value, ['.', '..'] + value.keys())
+        for name, child in value.iteritems():
+            stack.append((prefix + name, child))
+
+    return index
+
+
+def changed_names(old, new):
+    """
+    :param old: The previous version of a host
+    :type old: dict
+    :param new: The new version of the host
+    :type new: dict
+    :return: The top level names whose value differs between the versions, including names only in one of them
+    :rtype: list
+    """
+    return [name for name in set(old).union(new) if name not in old or name not in new or not old[name] == new[name]]
+
+
+class PathIndex(object):
+    """
+    Maps normalized paths straight to their Node, so lookups don't have to walk the structure for every
+    request. Every host has its own index which can be replaced on its own when that host is refreshed.
+    """
+
+    def __init__(self, struct, renders=None):
+        if renders is None:
+            renders = RenderCache()
+        self.renders = renders
+        self.struct = materialize_lists(struct)
+        self.hosts = {}
+        self.root = None
+        self.rebuild()
+
+    def rebuild(self):
+        """
+        (Re)build the index for every host in the structure
+        """
+        hosts = {}
+        for host in self.struct.keys():
+            hosts[host] = build_host_index(self.struct[host])
+        self.hosts = hosts
+        self.renders.clear()
+        self._update_root()
+
+    def _update_root(self):
+        self.root = Node(self.struct, ['.', '..'] + self.struct.keys())
+
+    def host_names(self):
+        """
+        :return: The name of every host in the index
+        :rtype: list
+        """
+        return self.root.children[2:]
+
+    def host_digest(self, host):
+        """
+        :return: A digest of the contents of a host which is equal for equal contents, or None when the index
+                 can only tell by comparing the decoded hosts
+        :rtype: str
+        """
+        return None
+
+    def fact_digests(self, host):
+        """
+        :return: Dictionary of every top level name of a host to a digest of its contents which is equal for
+                 equal contents, or None when the index can only tell by comparing the decoded hosts
+        :rtype: dict
+        """
+        return None
+
+    def host_struct(self, host):
+        """
+        :return: The subtree of a host, with its lists materialized
+        :rtype: dict
+        """
+        return self.struct[host]
+
+    def _host_index(self, host):
+        """
+        :return: The index of a host to take nodes over into, or None when the host isn't indexed
+        :rtype: dict
+        """
+        return self.hosts.get(host)
+
+    def _adopt_host(self, host, host_index):
+        self.hosts[host] = host_index
+        self.struct[host] = host_index[''].value
+
+    def _adopt_names(self, host, old_index, names):
+        """
+        Replace the nodes of the top level names of a host by those in old_index, the index of the host in
+        the index this one replaces when it has one. Names missing from either index, such as facts a
+        transform or projection dropped while the digests describe the cache, are left alone.
+
+        :return: The nodes taken over
+        :rtype: set
+        """
+        if old_index is None:
+            return set()
+        host_index = self._host_index(host)
+        if host_index is None:
+            return set()
+
+        struct = host_index[''].value
+        names = set(name for name in names if name in struct and name in old_index)
+        kept = set()
+        for path, node in old_index.iteritems():
+            if path.partition('/')[0] in names:
+                host_index[path] = node
+                kept.add(node)
+        for name in names:
+            struct[name] = old_index[name].value
+        return kept
+
+    def adopt(self, old):
+        """
+        Take over the nodes of every host and top level fact which didn't change from the index this one
+        replaces, together with their rendered contents, so only what changed is rendered again. Hosts are
+        compared by their digests and the top level facts of hosts whose digest changed by theirs, so
+        nothing is decoded. Only when either index has no digests for a host, both versions of the host
+        are decoded and their top level values compared. Call this before the index is used.
+
+        :param old: The index this one replaces
+        :type old: PathIndex
+        :return: Dictionary of every host which was added, removed or changed to the top level names within
+                 it which changed, where '' stands for the directory of the host itself. Removed hosts map to
+                 None.
+        :rtype: dict
+        """
+        self.renders = old.renders
+        changes = {}
+        old_hosts = set(old.host_names())
+        hosts = set(self.host_names())
+        for host in old_hosts - hosts:
+            self.renders.invalidate_host(host)
+            changes[host] = None
+
+        for host in hosts:
+            if host not in old_hosts:
+                names = self.fact_digests(host)
+                if names is None:
+                    names = self.host_struct(host)
+                changes[host] = [''] + list(names)
+                continue
+
+            old_index = old.hosts.get(host)
+            digest = self.host_digest(host)
+            if digest is None or not digest == old.host_digest(host):
+                old_facts = old.fact_digests(host)
+                facts = self.fact_digests(host)
+                if old_facts is None or facts is None:
+                    old_facts = old.host_struct(host)
+                    facts = self.host_struct(host)
+                changed = changed_names(old_facts, facts)
+                if changed:
+                    unchanged = set(facts).difference(changed)
+                    self.renders.invalidate_host(host, self._adopt_names(host, old_index, unchanged))
+                    if not set(old_facts) == set(facts):
+                        changed.append('')
+                    changes[host] = changed
+                    continue
+
+            if old_index is None:
+                self.renders.invalidate_host(host)
+            else:
+                self._adopt_host(host, old_index)
+        return changes
+
+    def lookup(self, path):
+        """
+        :param path: Absolute path as passed by FUSE
+        :type path: str
+        :return: The Node at the path or None when it doesn't exist
+        :rtype: Node
+        """
+        path = path.strip('/')
+        if not path:
+            return self.root
+
+        host, _, rest = path.partition('/')
+        try:
+            return self.hosts[host][rest]
+        except KeyError:
+            return None
+
+    def render(self, path, node):
+        """
+        :param path: Absolute path of the node
+        :type path: str
+        :param node: The leaf found at path
+        :type node: Node
+        :return: The contents of the leaf as exposed in the filesystem
+        :rtype: str
+        """
+        return self.renders.get(path.strip('/').partition('/')[0], node)
+
+    def size(self, path, node):
+        """
+        :return: The size in bytes of the leaf at path
+        :rtype: int
+        """
+        return len(self.render(path, node))
+
+    def read(self, path, node, offset, length):
+        """
+        :return: length bytes of the leaf at path, starting at offset
+        :rtype: str
+        """
+        return self.render(path, node)[offset:offset + length]
+
+    def replace_host(self, host, struct):
+        """
+        Put a new subtree in place for a host and reindex only that host. The index of the host is built
+        before it is swapped in, so concurrent lookups see either the old or the new host.
+
+        :param host: The host to replace
+        :type host: str
+        :param struct: The new subtree of the host
+        :type struct: dict
+        """
+        new_host = host not in self.hosts
+        struct = materialize_lists(struct)
+        host_index = build_host_index(struct)
+        self.hosts[host] = host_index
+        self.struct[host] = struct
+        self.renders.invalidate_host(host)
+        if new_host:
+            self._update_root()
@@ -0,0 +1,100 @@
+import re
+from fnmatch import translate
+
+WILDCARD = re.compile(r'[*?[]')
+
+
+def _literal_prefix(pattern):
+    match = WILDCARD.search(pattern)
+    if match is None:
+        return pattern
+    return pattern[:match.start()]
+
+
+def _compile(patterns):
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:%s)' % translate(pattern) for pattern in patterns))
+
+
+def _may_match_below(prefixes, path):
+    directory = path + '/'
+    for prefix in prefixes:
+        if prefix.startswith(directory) or directory.startswith(prefix):
+            return True
+    return False
+
+
+class Projection(object):
+    """
+    Selects the parts of a host to keep by path patterns relative to the host, such as ansible_env/* or
+    mounts/*/options. The patterns are matched with fnmatch, where * also matches slashes. A path is kept
+    when it, or one of the directories it is in, matches an include pattern, and neither the path nor one
+    of those directories matches an exclude pattern. Without include patterns everything is included.
+    Lists are matched as a whole.
+    """
+
+    def __init__(self, include=None, exclude=None):
+        self.include = include or []
+        self.exclude = exclude or []
+        self.include_re = _compile(self.include)
+        self.exclude_re = _compile(self.exclude)
+        self.include_prefixes = [_literal_prefix(pattern) for pattern in self.include]
+        self.exclude_prefixes = [_literal_prefix(pattern) for pattern in self.exclude]
+
+    def __nonzero__(self):
+        return bool(self.include or self.exclude)
+
+    def excluded(self, path):
+        """
+        :return: Whether the path, and everything below it, is dropped
+        :rtype: bool
+        """
+        return self.exclude_re is not None and self.exclude_re.match(path) is not None
+
+    def included(self, path):
+        """
+        :return: Whether the path, and everything below it which isn't excluded, is kept
+        :rtype: bool
+        """
+        return self.include_re is None or self.include_re.match(path) is not None
+
+    def walk(self, path, included):
+        """
+        :param path: Path of a directory which is kept as a whole when included and dropped as a whole otherwise
+        :type path: str
+        :param included: Whether the directory is included
+        :type included: bool
+        :return: Whether the directory has to be walked instead, as patterns could match paths below it
+        :rtype: bool
+        """
+        if included:
+            return _may_match_below(self.exclude_prefixes, path)
+        return _may_match_below(self.include_prefixes, path)
+
+    def apply(self, struct, prefix='', included=False):
+        """
+        :param struct: The structure of a host, or a directory within it
+        :type struct: dict
+        :param prefix: Path of struct within the host, ending in a slash
+        :type prefix: str
+        :param included: Whether struct is in an included directory
+        :type included: bool
+        :return: A copy of struct with only what is kept. Directories left without anything to keep are
+                 dropped, unless they were included themselves.
+        :rtype: dict
+        """
+        result = {}
+        for key, value in struct.iteritems():
+            path = prefix + key
+            if self.excluded(path):
+                continue
+
+            keep = included or self.included(path)
+            if type(value) == dict and self.walk(path, keep):
+                value = self.apply(value, path + '/', keep)
+                if keep or value:
+                    result[key] = value
+            elif keep:
+                result[key] = value
+        return result
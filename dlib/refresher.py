@@ -0,0 +1,83 @@
+import threading
+import time
+import Queue
+
+
+class Refresher(threading.Thread):
+    """
+    Runs realtime refreshes in the background, so reads can be answered with the last known value in the
+    meantime. Refreshes are single-flight per key: while one is queued or running, requests for the same
+    key wait on or piggyback on it instead of running another one. Those requests are counted in coalesced.
+
+    Requests arriving within window seconds of each other are batched: every refresh function is called
+    once with the list of arguments of all its requests in the batch.
+    """
+
+    def __init__(self, window=0.2):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.window = window
+        self.queue = Queue.Queue()
+        self.flights = {}
+        self.coalesced = 0
+        self.lock = threading.Lock()
+
+    def request(self, key, func, arg):
+        """
+        Queue a refresh unless a refresh for key is already in flight
+
+        :param key: Identifies what is refreshed, e.g. the host
+        :param func: The function performing the refresh, called with a list of arguments
+        :type func: function
+        :param arg: The argument for func identifying what to refresh
+        :return: Event which is set once the refresh is done
+        :rtype: threading.Event
+        """
+        with self.lock:
+            try:
+                done = self.flights[key]
+                self.coalesced += 1
+                return done
+            except KeyError:
+                done = self.flights[key] = threading.Event()
+        self.queue.put((key, func, arg, done))
+        return done
+
+    def refresh(self, key, func, arg):
+        """
+        Like request, but wait until the refresh is done
+        """
+        self.request(key, func, arg).wait()
+
+    def _run_batch(self, func, jobs):
+        try:
+            func([arg for key, _, arg, done in jobs])
+        except Exception, e:
+            print "Refreshing %s failed: %s" % (', '.join(str(job[0]) for job in jobs), e)
+        finally:
+            with self.lock:
+                for key, _, arg, done in jobs:
+                    del self.flights[key]
+            for key, _, arg, done in jobs:
+                done.set()
+
+    def run(self):
+        while True:
+            jobs = [self.queue.get()]
+            deadline = time.time() + self.window
+            while True:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    jobs.append(self.queue.get(timeout=timeout))
+                except Queue.Empty:
+                    break
+
+            batches = {}
+            for job in jobs:
+                batches.setdefault(job[1], []).append(job)
+            for func, batch in batches.items():
+                t = threading.Thread(target=self._run_batch, args=(func, batch))
+                t.daemon = True
+                t.start()
@@ -0,0 +1,59 @@
+import os
+import threading
+import time
+
+
+def file_version(filename):
+    """
+    :param filename: Path of the file
+    :type filename: str
+    :return: What identifies the current version of the file: its inode, size and mtime, or None when it
+             doesn't exist
+    :rtype: tuple
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime
+
+
+class Reloader(threading.Thread):
+    """
+    Watches a cache file by polling its inode, size and mtime every interval seconds. When it changed, the
+    new version is loaded in this thread by calling load, and the result is passed to swap. Writers are
+    expected to replace the file with a rename, so a half written file is never seen. Reads keep being
+    answered from the old version while the new one loads. A version is only recorded once it was swapped
+    in, so a failed reload is tried again after the next interval.
+    """
+
+    def __init__(self, filename, version, load, swap, interval=5):
+        """
+        :param filename: Path of the cache file
+        :type filename: str
+        :param version: The file_version of the cache taken before the version in use was loaded, so a cache
+                        replaced while it was loading is reloaded
+        :type version: tuple
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.filename = filename
+        self.load = load
+        self.swap = swap
+        self.interval = interval
+        self.version = version
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            version = file_version(self.filename)
+            if version is None or version == self.version:
+                continue
+
+            print "Reloading %s" % self.filename
+            try:
+                self.swap(self.load())
+            except Exception, e:
+                print "Reloading %s failed: %s" % (self.filename, e)
+                continue
+            self.version = version
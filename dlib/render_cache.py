@@ -0,0 +1,100 @@
+import threading
+from collections import OrderedDict
+
+
+def render_value(value):
+    """
+    Render a leaf value to the bytes exposed as file contents
+
+    :param value: The value of the leaf
+    :return: The encoded contents, including the trailing newline
+    :rtype: str
+    """
+    if type(value) == unicode:
+        return value.encode('utf-8') + "\n"
+    return str(value) + "\n"
+
+
+class RenderCache(object):
+    """
+    Keeps the rendered contents of leaves around so stat and every chunk of a read use the same buffer.
+    Small values are kept on the Node itself and disappear together with it, larger values are kept in an
+    LRU bounded by max_bytes which can be invalidated per host.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, inline_limit=4096):
+        self.max_bytes = max_bytes
+        self.inline_limit = inline_limit
+        self.size = 0
+        self.entries = OrderedDict()
+        self.host_entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, host, node):
+        """
+        :param host: The host the node belongs to
+        :type host: str
+        :param node: The leaf to render
+        :type node: Node
+        :return: The rendered contents of the node
+        :rtype: str
+        """
+        data = node.rendered
+        if data is not None:
+            return data
+
+        with self.lock:
+            try:
+                data = self.entries.pop(node)[1]
+                self.entries[node] = (host, data)
+                return data
+            except KeyError:
+                pass
+
+        data = render_value(node.value)
+        if len(data) <= self.inline_limit:
+            node.rendered = data
+        elif len(data) <= self.max_bytes:
+            self._store(host, node, data)
+        return data
+
+    def _store(self, host, node, data):
+        with self.lock:
+            if node in self.entries:
+                return
+            self.entries[node] = (host, data)
+            self.host_entries.setdefault(host, set()).add(node)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                old_node, (old_host, old_data) = self.entries.popitem(last=False)
+                self._forget(old_host, old_node, old_data)
+
+    def _forget(self, host, node, data):
+        self.size -= len(data)
+        nodes = self.host_entries[host]
+        nodes.discard(node)
+        if not nodes:
+            del self.host_entries[host]
+
+    def invalidate_host(self, host, keep=()):
+        """
+        Drop the cached values of a host, used when the host is replaced
+
+        :param host: The host to invalidate
+        :type host: str
+        :param keep: Nodes whose cached values are kept, as they are taken over by the new host
+        :type keep: set
+        """
+        with self.lock:
+            nodes = self.host_entries.pop(host, set())
+            kept = nodes.intersection(keep)
+            for node in nodes - kept:
+                self.size -= len(self.entries.pop(node)[1])
+            if kept:
+                self.host_entries[host] = kept
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.host_entries.clear()
+            self.size = 0
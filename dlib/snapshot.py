@@ -0,0 +1,326 @@
+import hashlib
+import json
+import mmap
+import os
+from struct import Struct
+
+from path_index import Node, PathIndex, materialize_lists
+from render_cache import render_value
+
+# A snapshot consists of a header, a table of fixed size node records and a string pool. Node 0 is the
+# root. The children of a directory are stored next to each other, sorted by their utf-8 encoded name,
+# so a path component can be resolved with a binary search directly on the mapped file. For directories
+# the two trailing fields of a record hold the index of the first child and the number of children, for
+# leaves they hold the offset and length of the rendered value in the string pool. Since version 2 the
+# pool is followed by a table of digests for the hosts and their top level facts, which are the nodes
+# right after the root as nodes are stored breadth first, so a reload can tell what changed without
+# decoding anything.
+MAGIC = 'DMSNAP02'
+HEADER = Struct('<8sIQQQI')
+# Version 1 snapshots, without digests, can still be read
+MAGIC_V1 = 'DMSNAP01'
+HEADER_V1 = Struct('<8sIQQ')
+NODE = Struct('<BQIQI')
+DIGEST_SIZE = 8
+DIR = 0
+LEAF = 1
+# Values up to this size are stored only once in the string pool
+INTERN_LIMIT = 64
+
+
+def _digest(data):
+    return hashlib.md5(data).digest()[:DIGEST_SIZE]
+
+
+def _encode(name):
+    if type(name) == unicode:
+        return name.encode('utf-8')
+    return str(name)
+
+
+def is_snapshot(filename):
+    """
+    :param filename: Path of the cache file
+    :type filename: str
+    :return: Whether the file is a snapshot rather than a json file
+    :rtype: bool
+    """
+    f = open(filename, 'rb')
+    magic = f.read(len(MAGIC))
+    f.close()
+    return magic in (MAGIC, MAGIC_V1)
+
+
+def save_snapshot(filename, struct):
+    """
+    Save the passed structure as a snapshot which datamounter.py can memory map. The snapshot is written
+    next to filename and renamed over it once complete, so a mount reloading it never sees half of it.
+
+    :param filename: Path to the file to write to
+    :type filename: str
+    :param struct: structure to save. Lists in it are materialized in place
+    :type struct: dict
+    :rtype: None
+    """
+    struct = materialize_lists(struct)
+    records = [[DIR, 0, 0, 0, 0]]
+    pool = []
+    interned = {}
+    pool_size = [0]
+
+    def add_string(data):
+        if len(data) <= INTERN_LIMIT:
+            try:
+                return interned[data]
+            except KeyError:
+                pass
+        offset = pool_size[0]
+        pool.append(data)
+        pool_size[0] += len(data)
+        if len(data) <= INTERN_LIMIT:
+            interned[data] = offset
+        return offset
+
+    # Digests of hosts and top level facts by node index. A host digest is taken over the digests of its
+    # facts, so every value is only encoded once.
+    digests = {}
+    queue = [(0, struct, 0)]
+    for number, value, depth in queue:
+        names = sorted((_encode(k), k) for k in value.keys())
+        records[number][3] = len(records)
+        records[number][4] = len(names)
+        if depth == 1:
+            host_digest = hashlib.md5()
+        for encoded_name, name in names:
+            child = value[name]
+            if depth == 1 or (depth == 0 and not type(child) == dict):
+                digests[len(records)] = _digest(json.dumps(child))
+            if depth == 1:
+                host_digest.update(encoded_name + '\0' + digests[len(records)])
+
+            name_offset = add_string(encoded_name)
+            if type(child) == dict:
+                queue.append((len(records), child, depth + 1))
+                records.append([DIR, name_offset, len(encoded_name), 0, 0])
+            else:
+                data = render_value(child)
+                records.append([LEAF, name_offset, len(encoded_name), add_string(data), len(data)])
+        if depth == 1:
+            digests[number] = host_digest.digest()[:DIGEST_SIZE]
+
+    node_offset = HEADER.size
+    pool_offset = node_offset + NODE.size * len(records)
+    digest_offset = pool_offset + pool_size[0]
+    digest_count = max(digests.keys() or [0])
+    partial_file = filename + '.partial'
+    f = open(partial_file, 'wb')
+    f.write(HEADER.pack(MAGIC, len(records), node_offset, pool_offset, digest_offset, digest_count))
+    for record in records:
+        f.write(NODE.pack(*record))
+    for data in pool:
+        f.write(data)
+    for number in xrange(1, digest_count + 1):
+        f.write(digests[number])
+    f.close()
+    os.rename(partial_file, filename)
+
+
+class Snapshot(object):
+    """
+    A memory mapped snapshot. Nothing is decoded up front; lookups and reads go straight to the mapping,
+    which is shared through the page cache between every process mounting the same file.
+    """
+
+    def __init__(self, filename):
+        f = open(filename, 'rb')
+        self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        magic = self.mm[:len(MAGIC)]
+        if magic == MAGIC:
+            _, self.node_count, self.node_offset, self.pool_offset, self.digest_offset, self.digest_count = \
+                HEADER.unpack_from(self.mm, 0)
+        elif magic == MAGIC_V1:
+            _, self.node_count, self.node_offset, self.pool_offset = HEADER_V1.unpack_from(self.mm, 0)
+            self.digest_offset = self.digest_count = 0
+        else:
+            raise ValueError('%s is not a datamounter snapshot' % filename)
+
+    def record(self, number):
+        return NODE.unpack_from(self.mm, self.node_offset + number * NODE.size)
+
+    def string(self, offset, length):
+        start = self.pool_offset + offset
+        return self.mm[start:start + length]
+
+    def digest(self, number):
+        """
+        :param number: Index of a host or top level fact node
+        :type number: int
+        :return: Digest of the contents of the node, or None when the snapshot has none for it
+        :rtype: str
+        """
+        if not 0 < number <= self.digest_count:
+            return None
+        start = self.digest_offset + (number - 1) * DIGEST_SIZE
+        return self.mm[start:start + DIGEST_SIZE]
+
+    def name(self, number):
+        record = self.record(number)
+        return self.string(record[1], record[2])
+
+    def find_child(self, number, name):
+        """
+        :param number: Index of the directory node
+        :type number: int
+        :param name: utf-8 encoded name of the child
+        :type name: str
+        :return: Index of the child node or None when it doesn't exist
+        :rtype: int
+        """
+        kind, _, _, first, count = self.record(number)
+        if not kind == DIR:
+            return None
+
+        low, high = first, first + count
+        while low < high:
+            middle = (low + high) // 2
+            if self.name(middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < first + count and self.name(low) == name:
+            return low
+        return None
+
+    def lookup(self, path, number=0):
+        """
+        :param path: Path relative to the node, without leading or trailing slashes
+        :type path: str
+        :param number: Index of the node to start from, defaults to the root
+        :type number: int
+        :return: The node at the path or None when it doesn't exist
+        :rtype: SnapshotNode
+        """
+        if not path:
+            return SnapshotNode(self, number)
+
+        for component in path.split('/'):
+            number = self.find_child(number, _encode(component))
+            if number is None:
+                return None
+        return SnapshotNode(self, number)
+
+    def child_names(self, number):
+        _, _, _, first, count = self.record(number)
+        return [self.name(i).decode('utf-8') for i in xrange(first, first + count)]
+
+    def child_numbers(self, number):
+        """
+        :return: Dictionary of the name of every child of a directory node to its index
+        :rtype: dict
+        """
+        _, _, _, first, count = self.record(number)
+        return dict((self.name(i).decode('utf-8'), i) for i in xrange(first, first + count))
+
+    def materialize(self, number):
+        """
+        Decode a subtree into python objects. Leaves come back as the unicode string they are rendered as.
+
+        :param number: Index of the node
+        :type number: int
+        :rtype: dict
+        """
+        kind, _, _, a, b = self.record(number)
+        if kind == LEAF:
+            return self.string(a, b)[:-1].decode('utf-8')
+        return dict((self.name(i).decode('utf-8'), self.materialize(i)) for i in xrange(a, a + b))
+
+
+class SnapshotNode(object):
+    """
+    Node backed by a record in a Snapshot, offering the same attributes as path_index.Node
+    """
+    __slots__ = ('snapshot', 'number', 'kind', 'a', 'b')
+
+    def __init__(self, snapshot, number):
+        self.snapshot = snapshot
+        self.number = number
+        self.kind, _, _, self.a, self.b = snapshot.record(number)
+
+    @property
+    def is_dir(self):
+        return self.kind == DIR
+
+    @property
+    def children(self):
+        if not self.kind == DIR:
+            return None
+        return ['.', '..'] + self.snapshot.child_names(self.number)
+
+    @property
+    def value(self):
+        return self.snapshot.materialize(self.number)
+
+    @property
+    def rendered(self):
+        return self.snapshot.string(self.a, self.b)
+
+
+class SnapshotIndex(PathIndex):
+    """
+    PathIndex serving hosts straight from a Snapshot. Hosts replaced by a realtime refresh are indexed
+    like a regular PathIndex and take precedence over the snapshot.
+    """
+
+    def __init__(self, snapshot, renders=None):
+        self.snapshot = snapshot
+        self.snapshot_hosts = snapshot.child_numbers(0)
+        PathIndex.__init__(self, {}, renders)
+
+    def _update_root(self):
+        names = self.snapshot_hosts.keys()
+        names.extend(host for host in self.struct.keys() if host not in self.snapshot_hosts)
+        self.root = Node(self.struct, ['.', '..'] + names)
+
+    def lookup(self, path):
+        path = path.strip('/')
+        if not path:
+            return self.root
+
+        host, _, rest = path.partition('/')
+        try:
+            host_index = self.hosts[host]
+        except KeyError:
+            try:
+                return self.snapshot.lookup(rest, self.snapshot_hosts[host])
+            except KeyError:
+                return None
+        return host_index.get(rest)
+
+    def host_digest(self, host):
+        if host in self.hosts:
+            return None
+        return self.snapshot.digest(self.snapshot_hosts[host])
+
+    def fact_digests(self, host):
+        if host in self.hosts or not self.snapshot.digest_count:
+            return None
+        return dict((name, self.snapshot.digest(number))
+                    for name, number in self.snapshot.child_numbers(self.snapshot_hosts[host]).iteritems())
+
+    def host_struct(self, host):
+        if host in self.hosts:
+            return self.struct[host]
+        return self.snapshot.materialize(self.snapshot_hosts[host])
+
+    def size(self, path, node):
+        if type(node) == SnapshotNode:
+            return node.b
+        return PathIndex.size(self, path, node)
+
+    def read(self, path, node, offset, length):
+        if type(node) == SnapshotNode:
+            length = max(0, min(length, node.b - offset))
+            return self.snapshot.string(node.a + offset, length)
+        return PathIndex.read(self, path, node, offset, length)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+from StringIO import StringIO
+
+from dlib.lazy_json import iter_members, scan_object, skip_value
+
+# Strings holding quotes, backslashes and brackets, which the scanner has to skip over without taking
+# them for the end of a string or a nesting level
+TRICKY = r'''{
+  "quote\"d": "a \"quoted\" value",
+  "brackets": {"open": "{[", "close": "]}", "list": ["}", "]", "\\", "\\\"]"]},
+  "backslash\\": "ends in a backslash\\",
+  "escaped é": "unicode é 😀",
+  "hété": {"utf-8": "café"},
+  "nested": [[{"a": [1, 2.5e3, -3]}], {}, [], "[{"],
+  "scalars": [true, false, null, 0, -0.5],
+  "empty": ""
+}
+'''
+
+
+def members_of(document):
+    return dict((key, json.loads(document[start:end])) for key, start, end in scan_object(document))
+
+
+class SkipValueTest(unittest.TestCase):
+    def test_strings(self):
+        for value in [r'""', r'"\""', r'"\\"', r'"a\\\"b"', r'"{[}]"']:
+            self.assertEqual(skip_value(value + ', "next"', 0), len(value))
+
+    def test_containers(self):
+        for value in [r'{}', r'[]', r'{"a": "}"}', r'["]", "\"]"]', r'[[{"a": ["{"]}]]', r'{"\"}": {"]": 1}}']:
+            self.assertEqual(skip_value(value + ', "next"', 0), len(value))
+
+    def test_scalars(self):
+        for value in ['1', '-2.5e10', 'true', 'false', 'null']:
+            self.assertEqual(skip_value(value + '}', 0), len(value))
+
+
+class ScanObjectTest(unittest.TestCase):
+    def test_matches_json(self):
+        self.assertEqual(members_of(TRICKY), json.loads(TRICKY))
+
+    def test_keys(self):
+        keys = [key for key, _, _ in scan_object(TRICKY)]
+        self.assertIn(u'quote"d', keys)
+        self.assertIn(u'backslash\\', keys)
+        self.assertIn(u'escaped \xe9', keys)
+        self.assertIn(u'h\xe9t\xe9', keys)
+        for key in keys:
+            self.assertEqual(type(key), unicode)
+
+    def test_empty(self):
+        self.assertEqual(list(scan_object(' { } ')), [])
+
+    def test_invalid(self):
+        for document in ['[]', '{"a" 1}', '{"a": 1 "b": 2}']:
+            self.assertRaises(ValueError, list, scan_object(document))
+
+
+class IterMembersTest(unittest.TestCase):
+    def test_every_chunk_size(self):
+        expected = json.loads(TRICKY)
+        for chunk_size in range(1, len(TRICKY) + 2):
+            members = dict((key, json.loads(data)) for key, data in iter_members(StringIO(TRICKY), chunk_size))
+            self.assertEqual(members, expected, 'chunk size %s' % chunk_size)
+
+    def test_every_cut(self):
+        # Every value comes out whole, whichever byte the chunk before it ends on
+        expected = json.loads(TRICKY)
+        for cut in range(1, len(TRICKY)):
+            members = dict(iter_members(StringIO(TRICKY), cut))
+            self.assertEqual(sorted(members), sorted(expected))
+
+    def test_empty(self):
+        self.assertEqual(list(iter_members(StringIO('{}'), 1)), [])
+
+    def test_truncated(self):
+        for end in range(1, len(TRICKY) - 3):
+            members = iter_members(StringIO(TRICKY[:end]), 7)
+            self.assertRaises(ValueError, list, members)
+
+
+if __name__ == '__main__':
+    unittest.main()
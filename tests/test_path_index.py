@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from dlib.json_stream import JsonObjectWriter
+from dlib.lazy_json import LazyIndex
+from dlib.projection import Projection
+
+
+def host(hostname):
+    return {
+        'ansible_hostname': hostname,
+        'ansible_env': {'HOME': '/root'},
+        'ansible_interfaces': ['lo', 'eth0'],
+        'ansible_date_time': {'epoch': '1'},
+    }
+
+
+def drop_lists(struct):
+    for name, value in struct.items():
+        if type(value) == list:
+            del struct[name]
+
+
+class AdoptTest(unittest.TestCase):
+    """
+    A reload of a lazy mount compares the digests written next to the cache, which describe the hosts as
+    stored, while the index holds them after a transform or projection
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'cache.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, hosts):
+        writer = JsonObjectWriter(self.filename)
+        for name, struct in sorted(hosts.items()):
+            writer.write(name, struct)
+        writer.close()
+
+    def reload(self, **options):
+        hosts = {'a': host('a'), 'b': host('b')}
+        self.write(hosts)
+        old = LazyIndex(self.filename, **options)
+        old.lookup('/a/ansible_hostname')
+        old_env = old.lookup('/a/ansible_env')
+
+        hosts['a']['ansible_date_time'] = {'epoch': '2'}
+        self.write(hosts)
+        index = LazyIndex(self.filename, **options)
+        changes = index.adopt(old)
+        self.assertEqual(set(changes), set(['a']))
+        self.assertEqual(index.lookup('/a/ansible_date_time/epoch').value, '2')
+        return old_env, index
+
+    def test_transform(self):
+        old_env, index = self.reload(transform=drop_lists)
+        self.assertIs(index.lookup('/a/ansible_env'), old_env)
+        self.assertIsNone(index.lookup('/a/ansible_interfaces'))
+
+    def test_projection(self):
+        old_env, index = self.reload(projection=Projection(exclude=['ansible_env']))
+        self.assertIsNone(old_env)
+        self.assertIsNone(index.lookup('/a/ansible_env'))
+        self.assertEqual(index.lookup('/a/ansible_interfaces/listitem_1').value, 'eth0')
+
+
+if __name__ == '__main__':
+    unittest.main()